@@ -5,22 +5,275 @@ Configurations."""
 
 import argparse
 import getpass
+import hashlib
 import json
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, \
+    FIRST_COMPLETED
 from fnmatch import fnmatch
 
 import requests
 import urllib3
-from avi.sdk.avi_api import ApiSession
+from avi.sdk.avi_api import ApiSession, APIError, ObjectNotFound
+from tabulate import tabulate
+
+
+class BackupArchive:
+    # A backup archive consists of a header, then separately compressed
+    # JSON records written as soon as each VS is received, then a
+    # compressed JSON index of the location of each record and finally a
+    # fixed-size footer giving the location of the index. Records can
+    # therefore be read individually without reading the whole archive.
+    #
+    # Each VS export is split into its individual objects, which are
+    # stored only once each keyed by a hash of their content, so that
+    # objects shared by many VSs (profiles, certificates etc.) are not
+    # repeated. The record for each VS holds a manifest listing all of its
+    # objects plus any objects not already stored by an earlier record.
+    #
+    # An incremental archive is chained to a previous archive (and so to
+    # any archives that one is chained to). Unchanged VSs and objects are
+    # not stored again, but refer to records in the previous archives,
+    # identified by a third element in their location.
+
+    MAGIC = b'AVIBKUP1'
+    FOOTER = struct.Struct('>Q8s')
+
+    def __init__(self, filename, mode='r', previous=None):
+        self.filename = filename
+        self.writing = mode == 'w'
+        self.file = open(filename, 'wb' if self.writing else 'rb')
+        self.index = {'vs': {}, 'objects': {}, 'fingerprints': {},
+                      'parents': []}
+        self.legacy = False
+        self.lock = threading.Lock()
+        self.claimed = set()
+        self.pending = []
+        self.parents = {}
+        self.previous = previous
+        if self.writing:
+            self.file.write(self.MAGIC)
+            if previous:
+                self.chain(previous)
+            return
+        try:
+            if self.file.read(len(self.MAGIC)) != self.MAGIC:
+                # Backups made before the archive format was introduced
+                # are a single JSON document which must be read in full.
+                # The index then holds the VS configurations themselves.
+
+                self.file.seek(0)
+                self.index = {'vs': json.loads(self.file.read())}
+                self.legacy = True
+                return
+            index_end = self.file.seek(-self.FOOTER.size, 2)
+            index_offset, magic = self.FOOTER.unpack(
+                self.file.read(self.FOOTER.size))
+            if magic != self.MAGIC:
+                raise ValueError(f'{filename} is incomplete')
+            self.file.seek(index_offset)
+            self.index = json.loads(zlib.decompress(
+                self.file.read(index_end - index_offset)))
+        except (ValueError, OSError, zlib.error):
+            self.file.close()
+            raise
+        if not self.index.get('complete', True):
+            print(f'Warning: {filename} is incomplete as the backup was '
+                  f'interrupted. It only holds the Virtual Services backed '
+                  f'up before then.')
+
+    def chain(self, previous):
+        # Chains this archive to a previous archive. Paths to parent
+        # archives are stored relative to this archive. All objects of the
+        # previous archive are available to this one without being stored
+        # again.
+
+        base_dir = os.path.dirname(os.path.abspath(self.filename))
+        prev_dir = os.path.dirname(os.path.abspath(previous.filename))
+        self.index['parents'] = [
+            os.path.relpath(os.path.join(prev_dir, parent), base_dir)
+            for parent in [os.path.basename(previous.filename),
+                           *previous.index.get('parents', [])]]
+        for obj_hash, location in previous.index.get('objects', {}).items():
+            self.index['objects'][obj_hash] = self.parent_location(location)
+        self.claimed.update(self.index['objects'])
+
+    @staticmethod
+    def parent_location(location):
+        # Translates a location in the previous archive to a location in
+        # this archive. The previous archive is parent 0, and its own
+        # parents follow it.
+
+        return [location[0], location[1],
+                location[2] + 1 if len(location) > 2 else 0]
+
+    @staticmethod
+    def hash_passphrase(passphrase, salt=None):
+        # Returns a salted hash of the passphrase, so that an incremental
+        # backup can check that the previous backup used the same one
+        # without storing it
+
+        salt = bytes.fromhex(salt) if salt else os.urandom(16)
+        return [salt.hex(), hashlib.pbkdf2_hmac(
+            'sha256', (passphrase or '').encode(), salt, 100000).hex()]
+
+    def fingerprint(self, tenant_name, vs_name):
+        return self.index.get('fingerprints', {}).get(tenant_name, {}).get(
+            vs_name)
+
+    def carry_forward(self, tenant_name, vs_name):
+        # Adds an unchanged VS from the previous archive to this one
+
+        self.index['vs'].setdefault(tenant_name, {})[vs_name] = (
+            self.parent_location(self.previous.index['vs'][tenant_name][
+                vs_name]))
+        self.index['fingerprints'].setdefault(tenant_name, {})[vs_name] = (
+            self.previous.fingerprint(tenant_name, vs_name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # An archive left by an exception (or Ctrl-C) is still readable,
+        # but is marked as incomplete
+
+        self.close(complete=exc_type is None)
+
+    def prepare(self, content):
+        # Splits a VS export into its objects, hashing each and keeping only
+        # those not already stored or claimed by another VS. Safe to call
+        # concurrently from worker threads. Returns the compressed record
+        # (the manifest and new objects) along with the hashes of the new
+        # objects and of all objects the VS refers to, to pass to add_vs.
+
+        config = json.loads(content)
+        manifest = {'config': {}, 'objects': []}
+        objects = {}
+        fingerprint = []
+        for type_key, type_objects in config.items():
+            if not isinstance(type_objects, list):
+                manifest['config'][type_key] = type_objects
+                continue
+            for obj in type_objects:
+                obj_hash = hashlib.sha256(json.dumps(
+                    obj, sort_keys=True,
+                    separators=(',', ':')).encode()).hexdigest()[:32]
+                manifest['objects'].append([type_key, obj_hash])
+                objects[obj_hash] = obj
+                if 'uuid' in obj:
+                    fingerprint.append([type_key.lower(), obj['uuid'],
+                                        obj.get('_last_modified')])
+        with self.lock:
+            new_hashes = objects.keys() - self.claimed
+            self.claimed.update(new_hashes)
+        record = {'manifest': manifest,
+                  'objects': {obj_hash: objects[obj_hash]
+                              for obj_hash in new_hashes}}
+        return (zlib.compress(json.dumps(record).encode()), new_hashes,
+                set(objects), fingerprint)
+
+    def add_vs(self, tenant_name, vs_name, prepared):
+        # Writes the record for a VS. A VS may refer to objects claimed by
+        # another VS whose record has not been written yet, in which case
+        # it is only added to the index once they have been, so that the
+        # index never refers to missing objects.
+
+        record, new_hashes, obj_hashes, fingerprint = prepared
+        location = self.write(record)
+        for obj_hash in new_hashes:
+            self.index['objects'][obj_hash] = location
+        self.pending.append((tenant_name, vs_name, location, obj_hashes,
+                             fingerprint))
+        pending = []
+        for vs_pending in self.pending:
+            tenant_name, vs_name, location, obj_hashes, fingerprint = (
+                vs_pending)
+            if obj_hashes <= self.index['objects'].keys():
+                self.index['vs'].setdefault(tenant_name, {})[vs_name] = (
+                    location)
+                self.index['fingerprints'].setdefault(tenant_name, {})[
+                    vs_name] = fingerprint
+            else:
+                pending.append(vs_pending)
+        self.pending = pending
+
+    def write(self, packed):
+        offset = self.file.tell()
+        self.file.write(packed)
+        return [offset, len(packed)]
+
+    def read(self, location):
+        if len(location) > 2:
+            return self.parent(location[2]).read(location[:2])
+        self.file.seek(location[0])
+        return zlib.decompress(self.file.read(location[1]))
+
+    def parent(self, parent_num):
+        if parent_num not in self.parents:
+            self.parents[parent_num] = BackupArchive(os.path.join(
+                os.path.dirname(os.path.abspath(self.filename)),
+                self.index['parents'][parent_num]))
+        return self.parents[parent_num]
+
+    def load(self, location):
+        # Returns the configuration of a VS as originally exported
+
+        if self.legacy:
+            return location
+        record = json.loads(self.read(location))
+        if 'objects' not in self.index:
+            # Archive written before objects were de-duplicated
+
+            return record
+        records = {tuple(location): record}
+        config = dict(record['manifest']['config'])
+        for type_key, obj_hash in record['manifest']['objects']:
+            obj_location = tuple(self.index['objects'][obj_hash])
+            if obj_location not in records:
+                records[obj_location] = json.loads(self.read(obj_location))
+            config.setdefault(type_key, []).append(
+                records[obj_location]['objects'][obj_hash])
+        return config
+
+    def close(self, complete=True):
+        if self.writing:
+            self.index['complete'] = complete
+            index_offset = self.file.tell()
+            self.file.write(zlib.compress(json.dumps(self.index).encode()))
+            self.file.write(self.FOOTER.pack(index_offset, self.MAGIC))
+        self.file.close()
+        for parent in self.parents.values():
+            parent.close()
 
 
 class BackupRestore:
-    def __init__(self, api, filename, passphrase, tenant='*', confirm=False):
+    # Responses with these status codes are worth retrying
+
+    RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+    # Fields excluded when comparing a backup against live configuration
+
+    VOLATILE_FIELDS = {'_last_modified'}
+
+    # Imports may additionally fail due to a conflicting concurrent change
+
+    IMPORT_RETRY_STATUS_CODES = RETRY_STATUS_CODES | {409, 412}
+
+    def __init__(self, api, filename, passphrase, tenant='*', confirm=False,
+                 workers=8, retries=3):
 
         self.api = api
         self.filename = filename
         self.passphrase = passphrase
         self.confirm = confirm
         self.tenant = tenant
+        self.workers = workers
+        self.retries = retries
 
     @staticmethod
     def choice():
@@ -31,7 +284,131 @@ class BackupRestore:
             if choice and 'no'.startswith(choice):
                 return False
 
-    def backup(self, vs_match, include_certs=False):
+    def request(self, method, *args, retry_status_codes=RETRY_STATUS_CODES,
+                **kwargs):
+        # Makes an API request, retrying transient failures with exponential
+        # backoff. Returns the response (or None) and the error message (or
+        # None) of the final attempt, and the number of attempts made.
+
+        for attempt in range(1, self.retries + 2):
+            if attempt > 1:
+                time.sleep(2 ** (attempt - 2))
+            try:
+                rsp = getattr(self.api, method)(*args, **kwargs)
+            except requests.exceptions.RequestException as ex:
+                rsp, error = None, str(ex)
+                continue
+            if rsp.status_code < 300:
+                return rsp, None, attempt
+            error = rsp.text
+            if rsp.status_code not in retry_status_codes:
+                break
+        return rsp, error, attempt
+
+    def export_vs(self, archive, vs_uuid, include_certs=False):
+        # Exports a single VS. Returns the exported configuration prepared
+        # for adding to the archive and None, or None and an error message.
+
+        rsp, error, _ = self.request(
+            'get', f'configuration/export/virtualservice/{vs_uuid}',
+            params={'include_certs': include_certs,
+                    'passphrase': self.passphrase})
+        if error:
+            return None, error
+        try:
+            return archive.prepare(rsp.content), None
+        except (ValueError, AttributeError, TypeError) as ex:
+            # Not a valid configuration export. Nothing has been claimed
+            # in the archive, so the VS can simply be recorded as failed.
+
+            return None, f'Invalid export: {ex}'
+
+    def import_vs(self, tenant_name, config):
+        # Imports a single VS. Returns the error message (or None), the
+        # number of attempts made and the time taken.
+
+        start_time = time.perf_counter()
+        _, error, attempts = self.request(
+            'post', 'configuration/import',
+            data={'passphrase': self.passphrase, 'configuration': config},
+            tenant=tenant_name,
+            retry_status_codes=self.IMPORT_RETRY_STATUS_CODES)
+        return error, attempts, time.perf_counter() - start_time
+
+    @staticmethod
+    def shared_object_keys(config):
+        # Identifies the objects imported along with a VS. Two VSs that
+        # import the same object are not imported concurrently. System
+        # default objects always exist and are not considered.
+
+        return {(type_key, obj.get('uuid') or obj.get('name'))
+                for type_key, type_objects in config.items()
+                if isinstance(type_objects, list)
+                for obj in type_objects
+                if not obj.get('name', '').startswith('System-')}
+
+    def get_last_modified(self, object_types):
+        # Returns the last modified time of every object of the given types
+        # using a lightweight projected query for each type, concurrently
+
+        def type_last_modified(object_type):
+            try:
+                return {obj['uuid']: obj.get('_last_modified')
+                        for obj in self.api.get_objects_iter(
+                            object_type, tenant='*',
+                            params={'fields': '_last_modified'})}
+            except (APIError, ObjectNotFound):
+                return {}
+
+        last_modified = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for type_objects in executor.map(type_last_modified,
+                                             sorted(object_types)):
+                last_modified.update(type_objects)
+        return last_modified
+
+    def find_unchanged(self, previous, vs_keys, include_certs):
+        # Returns the VSs for which neither the VS nor any of the objects
+        # in its export have been modified since the previous backup. VSs
+        # can only be carried forward if they were exported with the same
+        # options and passphrase, otherwise no single passphrase could
+        # restore the archive.
+
+        if previous.index.get('include_certs') != include_certs:
+            return set()
+        salt, passphrase_hash = previous.index.get('passphrase',
+                                                   (None, None))
+        if (not salt or BackupArchive.hash_passphrase(self.passphrase, salt)
+                != [salt, passphrase_hash]):
+            print('The passphrase does not match the previous backup, so '
+                  'all Virtual Services will be exported.')
+            return set()
+        fingerprints = {vs_key: previous.fingerprint(*vs_key)
+                        for vs_key in vs_keys}
+        last_modified = self.get_last_modified(
+            {object_type for fingerprint in fingerprints.values()
+             if fingerprint for object_type, _, _ in fingerprint})
+        return {vs_key for vs_key, fingerprint in fingerprints.items()
+                if fingerprint
+                and all(o_modified is not None
+                        and last_modified.get(o_uuid) == o_modified
+                        for _, o_uuid, o_modified in fingerprint)}
+
+    def backup(self, vs_match, include_certs=False, previous=None):
+        if previous:
+            if os.path.abspath(previous) == os.path.abspath(self.filename):
+                print('The previous backup must be a different file.')
+                return
+            with BackupArchive(previous) as previous_archive:
+                if previous_archive.legacy:
+                    print(f'{previous} cannot be used for an incremental '
+                          f'backup as it is in the old backup format.')
+                    return
+                self.backup_vs(vs_match, include_certs, previous_archive)
+        else:
+            self.backup_vs(vs_match, include_certs)
+
+    def backup_vs(self, vs_match, include_certs=False, previous=None):
         vs_matched = {}
 
         print('Looking for matching Virtual Services...')
@@ -64,61 +441,287 @@ class BackupRestore:
 
         print()
 
-        backup_data = {}
-
-        for (tenant_name, vs_name), vs_uuid in vs_matched.items():
-            print(f'Backing up {vs_name}')
-            uri = f'configuration/export/virtualservice/{vs_uuid}'
-            params = {'include_certs': include_certs,
-                      'passphrase': self.passphrase}
-            rsp = self.api.get(uri, params=params)
-            if rsp.status_code >= 300:
-                raise Exception(f'Error backing up {vs_name}: {rsp.text}')
-            if tenant_name not in backup_data:
-                backup_data[tenant_name] = {}
-            backup_data[tenant_name][vs_name] = rsp.json()
+        failures = {}
+        start_time = time.perf_counter()
+
+        # For an incremental backup, only VSs that have changed since the
+        # previous backup are exported. The rest are carried forward by
+        # reference to the previous backup.
+
+        unchanged = set()
+        if previous:
+            unchanged = self.find_unchanged(previous, vs_matched,
+                                            include_certs)
+            print(f'{len(unchanged)} of {len(vs_matched)} Virtual Services '
+                  f'unchanged since the previous backup.')
+
+        # Export VSs concurrently, writing each to the archive as soon as it
+        # is received. A failure of one VS does not prevent the others from
+        # being backed up.
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor, \
+                BackupArchive(self.filename, 'w', previous) as archive:
+            archive.index['include_certs'] = include_certs
+            archive.index['passphrase'] = BackupArchive.hash_passphrase(
+                self.passphrase)
+            for vs_key in unchanged:
+                archive.carry_forward(*vs_key)
+            exports = {executor.submit(self.export_vs, archive, vs_uuid,
+                                       include_certs): vs_key
+                       for vs_key, vs_uuid in vs_matched.items()
+                       if vs_key not in unchanged}
+            num_exports = len(exports)
+
+            # Each export is dropped once written, so that memory use does
+            # not grow with the size of the backup
+
+            try:
+                for done, export in enumerate(as_completed(exports),
+                                              start=1):
+                    tenant_name, vs_name = exports.pop(export)
+                    vs_prepared, error = export.result()
+                    if error:
+                        failures[(tenant_name, vs_name)] = error
+                    else:
+                        archive.add_vs(tenant_name, vs_name, vs_prepared)
+                    elapsed = time.perf_counter() - start_time
+                    print(f'\rBacked up {done}/{num_exports} Virtual '
+                          f'Services ({done / elapsed:.1f}/s)', end='')
+            except BaseException:
+                for export in exports:
+                    export.cancel()
+                raise
 
-        with open(self.filename, 'w', encoding='UTF-8') as backup_file:
-            backup_file.write(json.dumps(backup_data))
+        print()
 
-        print('Backup complete.')
+        for (tenant_name, vs_name), error in sorted(failures.items()):
+            print(f'Error backing up {vs_name}@{tenant_name}: {error}')
 
-    def restore(self, vs_match):
-        with open(self.filename, 'r', encoding='UTF-8') as backup_file:
-            backup_data = json.loads(backup_file.read())
+        print(f'Backup complete: {len(vs_matched) - len(failures)} of '
+              f'{len(vs_matched)} Virtual Services backed up '
+              f'({len(unchanged)} unchanged) in '
+              f'{time.perf_counter() - start_time:.1f}s.')
 
+    def match_backup(self, archive, vs_match):
         vs_matched = {}
 
         print('Looking for matching Virtual Services...')
 
-        for tenant_name, vs in backup_data.items():
+        for tenant_name, vs in archive.index['vs'].items():
             if self.tenant in ('*', tenant_name):
-                for vs_name, backup in vs.items():
+                for vs_name, vs_entry in vs.items():
                     if fnmatch(vs_name, vs_match):
-                        vs_matched[(tenant_name, vs_name)] = backup
+                        vs_matched[(tenant_name, vs_name)] = vs_entry
                         print(vs_name, end='')
                         if self.tenant == '*':
                             print(f'@{tenant_name}', end='')
 
         if not vs_matched:
             print('\r\nNo matching Virtual Services found.')
-            return
 
-        if self.confirm:
-            print('\r\nConfirm restoring these Virtual Services?', end=' ')
-            if not self.choice():
+        return vs_matched
+
+    def restore(self, vs_match):
+        with BackupArchive(self.filename) as archive:
+            vs_matched = self.match_backup(archive, vs_match)
+            if not vs_matched:
                 return
 
+            if self.confirm:
+                print('\r\nConfirm restoring these Virtual Services?',
+                      end=' ')
+                if not self.choice():
+                    return
+
+            print()
+
+            configs = {vs_key: archive.load(vs_entry)
+                       for vs_key, vs_entry in vs_matched.items()}
+
+        self.restore_vs(configs)
+
+    @classmethod
+    def normalise(cls, value):
+        # Removes fields that change without any change in configuration
+
+        if isinstance(value, dict):
+            return {k: cls.normalise(v) for k, v in value.items()
+                    if k not in cls.VOLATILE_FIELDS}
+        if isinstance(value, list):
+            return [cls.normalise(v) for v in value]
+        return value
+
+    @classmethod
+    def object_hashes(cls, config):
+        # Returns the content hash and normalised content of each object in
+        # a VS export, keyed by object type and name
+
+        objects = {}
+        for type_key, type_objects in config.items():
+            if not isinstance(type_objects, list):
+                continue
+            for obj in type_objects:
+                obj = cls.normalise(obj)
+                obj_hash = hashlib.sha256(json.dumps(
+                    obj, sort_keys=True,
+                    separators=(',', ':')).encode()).hexdigest()
+                objects[(type_key, obj.get('name', obj.get('uuid')))] = (
+                    obj_hash, obj)
+        return objects
+
+    @classmethod
+    def field_diff(cls, backup, live, path=''):
+        # Yields the path, backup value and live value of each field that
+        # differs between two objects
+
+        if isinstance(backup, dict) and isinstance(live, dict):
+            for k in sorted(backup.keys() | live.keys()):
+                yield from cls.field_diff(backup.get(k), live.get(k),
+                                          f'{path}.{k}' if path else k)
+        elif (isinstance(backup, list) and isinstance(live, list)
+              and len(backup) == len(live)):
+            for i, (b, v) in enumerate(zip(backup, live)):
+                yield from cls.field_diff(b, v, f'{path}[{i}]')
+        elif backup != live:
+            yield path, backup, live
+
+    def diff_vs(self, tenant_name, vs_name, backup_config, include_certs):
+        # Exports the live configuration of a VS and compares the content
+        # hash of each of its objects against the backup. Returns the list
+        # of (object type, object name, difference, backup object, live
+        # object) and None, or None and an error message.
+
+        vs_uuid = next((vs['uuid']
+                        for vs in backup_config.get('VirtualService', [])
+                        if vs.get('name') == vs_name), None)
+        uri = f'configuration/export/virtualservice/{vs_uuid}'
+        params = {'include_certs': include_certs,
+                  'passphrase': self.passphrase}
+        rsp, error, _ = self.request('get', uri, params=params)
+        if rsp is not None and rsp.status_code == 404:
+            # The VS may have been re-created with a different UUID
+
+            vs = self.api.get_object_by_name('virtualservice', vs_name,
+                                             tenant=tenant_name)
+            if not vs:
+                return [('VirtualService', vs_name, 'not in live', None,
+                         None)], None
+            rsp, error, _ = self.request(
+                'get', f'configuration/export/virtualservice/{vs["uuid"]}',
+                params=params)
+        if error:
+            return None, error
+
+        backup_objects = self.object_hashes(backup_config)
+        live_objects = self.object_hashes(rsp.json())
+        differences = []
+        for (type_key, obj_name) in sorted(backup_objects.keys()
+                                           | live_objects.keys()):
+            backup_hash, backup_obj = backup_objects.get(
+                (type_key, obj_name), (None, None))
+            live_hash, live_obj = live_objects.get((type_key, obj_name),
+                                                   (None, None))
+            if backup_hash == live_hash:
+                continue
+            difference = ('not in live' if not live_hash
+                          else 'not in backup' if not backup_hash
+                          else 'modified')
+            differences.append((type_key, obj_name, difference, backup_obj,
+                                live_obj))
+        return differences, None
+
+    def diff(self, vs_match, show_fields=False):
+        with BackupArchive(self.filename) as archive:
+            vs_matched = self.match_backup(archive, vs_match)
+            if not vs_matched:
+                return
+
+            print()
+
+            include_certs = archive.index.get('include_certs', False)
+            configs = {vs_key: archive.load(vs_entry)
+                       for vs_key, vs_entry in vs_matched.items()}
+
+        start_time = time.perf_counter()
+        differing = 0
+
+        # Live configurations are exported and compared concurrently, but
+        # results are shown in order
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            diffs = {vs_key: executor.submit(self.diff_vs, *vs_key, config,
+                                             include_certs)
+                     for vs_key, config in sorted(configs.items())}
+            for (tenant_name, vs_name), vs_diff in diffs.items():
+                differences, error = vs_diff.result()
+                if error:
+                    print(f'Error checking {vs_name}@{tenant_name}: {error}')
+                    continue
+                if not differences:
+                    continue
+                differing += 1
+                print(f'{vs_name}@{tenant_name}:')
+                for (type_key, obj_name, difference, backup_obj,
+                     live_obj) in differences:
+                    print(f'  {type_key} {obj_name}: {difference}')
+                    if show_fields and difference == 'modified':
+                        for path, backup_value, live_value in \
+                                self.field_diff(backup_obj, live_obj):
+                            print(f'    {path}: {json.dumps(backup_value)} '
+                                  f'-> {json.dumps(live_value)}')
+
+        print(f'{differing} of {len(configs)} Virtual Services differ from '
+              f'the backup (checked in '
+              f'{time.perf_counter() - start_time:.1f}s).')
+
+    def restore_vs(self, configs):
+        # Imports VSs concurrently, except that a VS is not started while
+        # another VS that imports any of the same objects is in progress.
+        # VSs are otherwise started in their original order.
+
+        object_keys = {vs_key: self.shared_object_keys(config)
+                       for vs_key, config in configs.items()}
+        pending = deque(configs)
+        running = {}
+        busy = set()
+        results = {}
+        start_time = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                for vs_key in list(pending):
+                    if len(running) >= self.workers:
+                        break
+                    if object_keys[vs_key] & busy:
+                        continue
+                    pending.remove(vs_key)
+                    busy.update(object_keys[vs_key])
+                    running[executor.submit(self.import_vs, vs_key[0],
+                                            configs[vs_key])] = vs_key
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    vs_key = running.pop(future)
+                    busy.difference_update(object_keys[vs_key])
+                    results[vs_key] = future.result()
+                    print(f'\rRestored {len(results)}/{len(configs)} '
+                          f'Virtual Services', end='')
+
         print()
 
-        for (tenant_name, vs_name), backup in vs_matched.items():
-            print(f'Restoring {vs_name}')
-            uri = 'configuration/import'
-            data = {'passphrase': self.passphrase,
-                    'configuration': backup}
-            rsp = self.api.post(uri, data=data, tenant=tenant_name)
-            if rsp.status_code >= 300:
-                raise Exception(f'Error restoring {vs_name}: {rsp.text}')
+        print(tabulate([[vs_name, tenant_name,
+                         f'Failed: {error}' if error else 'OK', attempts,
+                         f'{elapsed:.1f}s']
+                        for (tenant_name, vs_name), (error, attempts, elapsed)
+                        in sorted(results.items())],
+                       headers=['Virtual Service', 'Tenant', 'Result',
+                                'Attempts', 'Time'],
+                       tablefmt='outline'))
+
+        failed = sum(1 for error, _, _ in results.values() if error)
+        print(f'Restore complete: {len(results) - failed} of {len(results)} '
+              f'Virtual Services restored in '
+              f'{time.perf_counter() - start_time:.1f}s.')
 
 # Disable certificate warnings
 
@@ -132,7 +735,7 @@ if hasattr(urllib3, 'disable_warnings'):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument('operation', choices=('backup', 'restore'))
+    parser.add_argument('operation', choices=('backup', 'restore', 'diff'))
     parser.add_argument('filename', help='Backup filename')
     parser.add_argument('-e', '--passphrase', help='Encryption passphrase')
     parser.add_argument('-c', '--controller',
@@ -149,6 +752,14 @@ if __name__ == '__main__':
                         'the backup', action='store_true')
     parser.add_argument('-n', '--noconfirm', help='Do not ask to confirm '
                         'operation', action='store_true')
+    parser.add_argument('-w', '--workers', help='Number of Virtual Services '
+                        'to process concurrently', type=int, default=8)
+    parser.add_argument('-r', '--retries', help='Number of times to retry '
+                        'a failed request', type=int, default=3)
+    parser.add_argument('-fd', '--fielddiff', help='Show field-level '
+                        'differences for diff', action='store_true')
+    parser.add_argument('-pr', '--previous', help='Previous backup file to '
+                        'make an incremental backup against')
 
     args = parser.parse_args()
 
@@ -167,6 +778,10 @@ if __name__ == '__main__':
         passphrase = args.passphrase
         include_certs = args.include_certs
         confirm = not args.noconfirm
+        workers = args.workers
+        retries = args.retries
+        previous = args.previous
+        show_fields = args.fielddiff
 
         while not controller:
             controller = input('Controller:')
@@ -185,10 +800,13 @@ if __name__ == '__main__':
                                      api_version=api_version)
 
         br = BackupRestore(api, filename, passphrase,
-                           tenant=tenant, confirm=confirm)
+                           tenant=tenant, confirm=confirm,
+                           workers=workers, retries=retries)
 
         if operation == 'backup':
-            br.backup(vs_match, include_certs)
+            br.backup(vs_match, include_certs, previous)
+        elif operation == 'diff':
+            br.diff(vs_match, show_fields)
         else:
             br.restore(vs_match)
 
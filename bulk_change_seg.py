@@ -5,6 +5,10 @@ in bulk."""
 
 import argparse
 import getpass
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import requests
 import urllib3
@@ -18,6 +22,385 @@ if hasattr(requests.packages.urllib3, 'disable_warnings'):
 if hasattr(urllib3, 'disable_warnings'):
     urllib3.disable_warnings()
 
+UUID_BATCH_SIZE = 100
+
+
+class PatchExecutor:
+    # Runs PATCH requests concurrently, adapting the number of requests in
+    # flight to the Controller's response: concurrency is increased by one
+    # after each full round of requests that complete without throttling or
+    # a significant rise in latency, and halved on a 429/5xx response or
+    # when latency rises well above its recent average. Transient failures
+    # are retried with exponential backoff. Where the Controller may have
+    # applied a failed request, it is only retried if applying it twice is
+    # harmless.
+
+    RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+    # Responses meaning the request was not processed, so is always safe to
+    # retry
+
+    SAFE_RETRY_STATUS_CODES = {429, 503}
+
+    LATENCY_FACTOR = 3
+    LATENCY_WEIGHT = 0.2
+
+    def __init__(self, api, tenant, max_workers=16, retries=3,
+                 method='patch'):
+        self.api = api
+        self.tenant = tenant
+        self.method = method
+        self.max_workers = max_workers
+        self.retries = retries
+        self.concurrency = min(4, max_workers)
+        self.peak_concurrency = self.concurrency
+        self.avg_latency = None
+        self.since_change = 0
+        self.last_decrease = 0
+        self.latencies = []
+        self.requests = 0
+        self.start_time = None
+
+    def idempotent(self, patch_data):
+        # Whether applying the request twice has the same effect as once: a
+        # PUT, or a PATCH that only replaces or deletes values. Adding to a
+        # list would add a second time.
+
+        if self.method == 'put':
+            return True
+        if isinstance(patch_data, str):
+            try:
+                patch_data = json.loads(patch_data)
+            except json.decoder.JSONDecodeError:
+                return False
+        if not isinstance(patch_data, dict):
+            return False
+        if 'json_patch' in patch_data:
+            return (set(patch_data) == {'json_patch'}
+                    and all(op.get('op') in ('replace', 'test')
+                            for op in patch_data['json_patch']))
+        return set(patch_data) <= {'replace', 'delete'}
+
+    def patch(self, vs_uuid, patch_data):
+        # Returns the final response (or None if the request could not be
+        # made), the error for a failed request, and the (latency, status
+        # code) of each attempt
+
+        idempotent = self.idempotent(patch_data)
+        retry_status_codes = (self.RETRY_STATUS_CODES if idempotent
+                              else self.SAFE_RETRY_STATUS_CODES)
+        attempts = []
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+            start_time = time.perf_counter()
+            try:
+                rsp = getattr(self.api, self.method)(
+                    f'virtualservice/{vs_uuid}', tenant=self.tenant,
+                    data=patch_data)
+            except requests.exceptions.RequestException as ex:
+                attempts.append((time.perf_counter() - start_time, None))
+                rsp, error = None, str(ex)
+                if (idempotent or isinstance(
+                        ex, requests.exceptions.ConnectTimeout)):
+                    continue
+                break
+            attempts.append((time.perf_counter() - start_time,
+                             rsp.status_code))
+            if rsp.status_code < 300:
+                return rsp, None, attempts
+            error = f'{rsp.status_code}: {rsp.text}'
+            if rsp.status_code not in retry_status_codes:
+                break
+        return rsp, error, attempts
+
+    def adapt(self, attempts):
+        # Adjusts concurrency based on the attempts made for one request
+
+        now = time.perf_counter()
+        self.requests += len(attempts)
+        latency, status_code = attempts[-1]
+        throttled = any(a_status is None or a_status == 429
+                        or a_status >= 500 for _, a_status in attempts)
+        slow = (self.avg_latency is not None
+                and latency > self.avg_latency * self.LATENCY_FACTOR)
+        if status_code is not None and status_code < 300:
+            self.latencies.append(latency)
+            if not throttled:
+                # Exponentially weighted moving average, so that a single
+                # unusually fast response does not become the baseline
+
+                self.avg_latency = (latency if self.avg_latency is None
+                                    else self.avg_latency
+                                    + (latency - self.avg_latency)
+                                    * self.LATENCY_WEIGHT)
+
+        if throttled or slow:
+            # Only back off once per round trip, as the requests already in
+            # flight were started at the previous concurrency
+
+            if now - self.last_decrease > latency:
+                self.concurrency = max(1, self.concurrency // 2)
+                self.last_decrease = now
+                self.since_change = 0
+        elif status_code is not None:
+            self.since_change += 1
+            if (self.since_change >= self.concurrency
+                    and self.concurrency < self.max_workers):
+                self.concurrency += 1
+                self.peak_concurrency = max(self.peak_concurrency,
+                                            self.concurrency)
+                self.since_change = 0
+
+    def run(self, items, callback):
+        # Patches each (vs_name, vs_uuid, patch_data) from items, calling
+        # callback(vs_name, vs_uuid, rsp, error) as each request completes
+
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        items = iter(items)
+        running = {}
+        exhausted = False
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                while not exhausted and len(running) < self.concurrency:
+                    item = next(items, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    vs_name, vs_uuid, patch_data = item
+                    running[executor.submit(self.patch, vs_uuid,
+                                            patch_data)] = (vs_name, vs_uuid)
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    vs_name, vs_uuid = running.pop(future)
+                    rsp, error, attempts = future.result()
+                    self.adapt(attempts)
+                    callback(vs_name, vs_uuid, rsp, error)
+
+    def percentile(self, pct):
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * pct / 100))]
+
+    def print_stats(self):
+        if not self.latencies:
+            return
+        elapsed = time.perf_counter() - self.start_time
+        print(f'{len(self.latencies)} updates in {elapsed:.1f}s '
+              f'({len(self.latencies) / elapsed:.1f}/s, '
+              f'{self.requests} requests, peak concurrency '
+              f'{self.peak_concurrency}).')
+        print(f'Latency p50 {self.percentile(50) * 1000:.0f}ms, '
+              f'p90 {self.percentile(90) * 1000:.0f}ms, '
+              f'p99 {self.percentile(99) * 1000:.0f}ms.')
+
+
+class WaveScheduler:
+    # Moves VSs to the destination SE Group in waves of at most wave_size.
+    # Within a wave, at most seg_limit VSs are being placed on the
+    # destination SE Group at any time: a moved VS that was OPER_UP before
+    # the move counts against the limit until it reports OPER_UP again on
+    # new SEs. Each wave must be fully placed before the next one starts,
+    # and if a VS does not come up within the timeout no further VSs are
+    # moved.
+
+    def __init__(self, api, tenant, patch_executor, wave_size, seg_limit,
+                 timeout=300, poll_interval=5):
+        self.api = api
+        self.tenant = tenant
+        self.patch_executor = patch_executor
+        self.wave_size = wave_size
+        self.seg_limit = seg_limit
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.not_ready = []
+        self.not_attempted = []
+
+    def get_runtime(self, vs_uuids):
+        # Returns a mapping of VS UUID to its oper state and the set of SE
+        # UUIDs it is placed on
+
+        runtime = {}
+        for i in range(0, len(vs_uuids), UUID_BATCH_SIZE):
+            batch = vs_uuids[i:i + UUID_BATCH_SIZE]
+            for vs in self.api.get_objects_iter(
+                    'virtualservice-inventory', tenant=self.tenant,
+                    params={'fields': 'config,runtime',
+                            'uuid.in': ','.join(batch),
+                            'page_size': len(batch)}):
+                vs_runtime = vs.get('runtime', {})
+                runtime[vs['config']['uuid']] = (
+                    vs_runtime.get('oper_status', {}).get('state'),
+                    {se['url'].split('#')[0].split('/')[-1]
+                     for vip in vs_runtime.get('vip_summary', [])
+                     for se in vip.get('service_engine', [])})
+        return runtime
+
+    def run(self, items, callback, track=iter):
+        # Moves each (vs_name, vs_uuid, patch_data) from items, calling
+        # callback(vs_name, vs_uuid, rsp, error) as each update completes.
+        # Each batch of items is passed through track before being handed
+        # to the PatchExecutor.
+
+        items = list(items)
+        waves = [items[i:i + self.wave_size]
+                 for i in range(0, len(items), self.wave_size)]
+        for wave_num, wave in enumerate(waves, 1):
+            print(f'Starting wave {wave_num} of {len(waves)} '
+                  f'({len(wave)} Virtual Service'
+                  f'{"" if len(wave) == 1 else "s"}).')
+            pre_runtime = self.get_runtime([vs_uuid
+                                            for _, vs_uuid, _ in wave])
+            placing = {}
+
+            def vs_moved(vs_name, vs_uuid, rsp, error):
+                # Only VSs that were up before the move are waited for, as
+                # a disabled or down VS will not come up on the new SEs
+
+                if (not error and pre_runtime.get(vs_uuid, (None,))[0]
+                        == 'OPER_UP'):
+                    placing[vs_uuid] = (vs_name, time.perf_counter())
+                callback(vs_name, vs_uuid, rsp, error)
+
+            queue = wave
+            while True:
+                free = self.seg_limit - len(placing)
+                if queue and free > 0 and not self.not_ready:
+                    self.patch_executor.run(track(queue[:free]), vs_moved)
+                    queue = queue[free:]
+                    continue
+                if not placing:
+                    break
+
+                time.sleep(self.poll_interval)
+                runtime = self.get_runtime(list(placing))
+                now = time.perf_counter()
+                for vs_uuid, (vs_name, moved_time) in list(placing.items()):
+                    # An SE belongs to exactly one SE Group, so a VS placed
+                    # only on SEs it was not on before the move is placed
+                    # on the destination SE Group rather than still
+                    # reporting its state on the source SE Group
+
+                    state, se_uuids = runtime.get(vs_uuid, (None, set()))
+                    if (state == 'OPER_UP' and se_uuids
+                            and not se_uuids & pre_runtime[vs_uuid][1]):
+                        print(f'Virtual Service {vs_name} is OPER_UP on '
+                              f'the destination SE Group')
+                        del placing[vs_uuid]
+                    elif now - moved_time > self.timeout:
+                        print(f'Virtual Service {vs_name} did not report '
+                              f'OPER_UP within {self.timeout}s '
+                              f'(state {state})')
+                        self.not_ready.append(f'"{vs_name}"')
+                        del placing[vs_uuid]
+
+            if self.not_ready:
+                self.not_attempted = [f'"{vs_name}"' for vs_name, _, _
+                                      in queue + sum(waves[wave_num:], [])]
+                print('Stopping migration as not all Virtual Services in '
+                      'the wave came up.')
+                break
+
+    def print_summary(self):
+        if not self.not_ready:
+            return
+        not_ready = len(self.not_ready)
+        print(f'{not_ready} Virtual Service{"" if not_ready == 1 else "s"} '
+              f'did not come up on the destination SE Group:')
+        print(','.join(self.not_ready))
+        not_attempted = len(self.not_attempted)
+        print(f'{not_attempted} Virtual Service'
+              f'{"" if not_attempted == 1 else "s"} not moved'
+              f'{":" if not_attempted else "."}')
+        if self.not_attempted:
+            print(','.join(self.not_attempted))
+
+
+class Journal:
+    # An append-only journal of a bulk change run, one JSON record per line.
+    # A 'start' record holding the pre-change value of each VS is written
+    # just before its update is sent, and an outcome record once the update
+    # has completed, so that an interrupted run can be resumed or rolled
+    # back.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.header = None
+        self.vs = {}
+        if os.path.exists(filename):
+            with open(filename, encoding='UTF-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        # A partially written record from an interrupted run
+
+                        continue
+                    self.apply(record)
+
+    def apply(self, record):
+        if record['type'] == 'run':
+            self.header = record
+        elif record['type'] == 'start':
+            self.vs.setdefault(record['uuid'], {'name': record['name'],
+                                                'pre': record['pre'],
+                                                'status': 'pending'})
+        else:
+            self.vs[record['uuid']]['status'] = record['type']
+            self.vs[record['uuid']]['status_code'] = record.get(
+                'status_code')
+
+    def write(self, record):
+        if not self.file:
+            self.file = open(self.filename, 'a+', encoding='UTF-8')
+            if self.file.tell():
+                # Make sure a partially written record is not continued
+
+                self.file.seek(self.file.tell() - 1)
+                if self.file.read(1) != '\n':
+                    self.file.write('\n')
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.apply(record)
+
+    def status(self, vs_uuid):
+        return self.vs.get(vs_uuid, {}).get('status')
+
+    def track(self, items, pre_image):
+        # Yields each (vs_name, vs_uuid, patch_data) from items, first
+        # recording the VS's pre-change value from pre_image(vs_uuid).
+        # Passed to PatchExecutor.run, which takes each item just before
+        # sending its update, so only VSs that are actually sent an update
+        # are recorded. A VS retried on resume keeps its original value.
+
+        for vs_name, vs_uuid, patch_data in items:
+            if not self.status(vs_uuid):
+                self.write({'type': 'start', 'uuid': vs_uuid,
+                            'name': vs_name, 'pre': pre_image(vs_uuid)})
+            yield vs_name, vs_uuid, patch_data
+
+    def rollback_list(self):
+        # VSs that have been (or may have been) changed and not yet rolled
+        # back. A failed update with no response or a 5xx response may
+        # still have been applied by the Controller.
+
+        return [(vs['name'], vs_uuid, vs['pre'])
+                for vs_uuid, vs in self.vs.items()
+                if vs['pre'] is not None
+                and (vs['status'] in ('pending', 'done', 'rollback_failed')
+                     or (vs['status'] == 'failed'
+                         and (vs['status_code'] is None
+                              or vs['status_code'] >= 500)))]
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -29,15 +412,50 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--tenant', help='Tenant',
                         default='admin')
     parser.add_argument('-x', '--apiversion', help='Avi API version')
-    parser.add_argument('source_seg',
-                        help='Source SE Group')
-    parser.add_argument('dest_seg',
-                        help='Destination SE Group')
+    parser.add_argument('source_seg', nargs='?',
+                        help='Source SE Group (not required with --rollback)')
+    parser.add_argument('dest_seg', nargs='?',
+                        help='Destination SE Group (not required with '
+                             '--rollback)')
     parser.add_argument('-i', '--include',
                         help='Comma-separated list of VSs to include. '
                              'If unspecified, all VSs will be included.')
     parser.add_argument('-e', '--exclude',
                         help='Comma-separated list of VSs to exclude.')
+    parser.add_argument('-w', '--workers',
+                        help='Maximum number of Virtual Services to update '
+                             'concurrently', type=int, default=16)
+    parser.add_argument('-r', '--retries',
+                        help='Number of times to retry a failed update',
+                        type=int, default=3)
+    parser.add_argument('-j', '--journal',
+                        help='Journal file recording the pre-change value '
+                             'and outcome of each update')
+    parser_j = parser.add_mutually_exclusive_group()
+    parser_j.add_argument('--resume',
+                          help='Resume an interrupted run from the journal, '
+                               'skipping VSs that were already updated',
+                          action='store_true')
+    parser_j.add_argument('--rollback',
+                          help='Restore the pre-change value of every VS '
+                               'updated in the journal',
+                          action='store_true')
+    parser.add_argument('-ws', '--wavesize',
+                        help='Move Virtual Services in waves of this size, '
+                             'waiting for each wave to come up on the '
+                             'destination SE Group before starting the next',
+                        type=int)
+    parser.add_argument('-sl', '--seglimit',
+                        help='Maximum number of Virtual Services being '
+                             'placed on the destination SE Group at once '
+                             '(default wave size; without -ws, all VSs '
+                             'are moved as one wave)', type=int)
+    parser.add_argument('-to', '--timeout',
+                        help='Seconds to wait for a moved Virtual Service '
+                             'to report OPER_UP', type=int, default=300)
+    parser.add_argument('-pi', '--pollinterval',
+                        help='Seconds between Virtual Service runtime polls',
+                        type=int, default=5)
 
     args = parser.parse_args()
 
@@ -54,6 +472,23 @@ if __name__ == '__main__':
         dest_seg = args.dest_seg
         vs_include = args.include.split(',') if args.include else None
         vs_exclude = args.exclude.split(',') if args.exclude else None
+        workers = args.workers
+        retries = args.retries
+        journal_file = args.journal
+        resume = args.resume
+        rollback = args.rollback
+        wave_size = args.wavesize
+        seg_limit = args.seglimit or wave_size
+        timeout = args.timeout
+        poll_interval = args.pollinterval
+
+        if (resume or rollback) and not journal_file:
+            print('A journal file must be specified with -j.')
+            exit()
+
+        if not ((source_seg and dest_seg) or rollback):
+            print('Source and destination SE Groups must be specified.')
+            exit()
 
         while not controller:
             controller = input('Controller:')
@@ -71,6 +506,60 @@ if __name__ == '__main__':
         api = ApiSession.get_session(controller, user, password,
                                      api_version=api_version)
 
+        journal = Journal(journal_file) if journal_file else None
+
+        if rollback:
+            # Move each VS back to the SE Group it was in before the change.
+            # The move back places VSs on the source SE Group's SEs, so it
+            # is made in waves if the original run was (unless waves are
+            # given on the command line).
+
+            header = journal.header or {}
+            if not (wave_size or seg_limit):
+                wave_size = header.get('wave_size')
+                seg_limit = header.get('seg_limit')
+            rollback_tenant = header.get('tenant', tenant)
+            rollback_executor = PatchExecutor(api, rollback_tenant,
+                                              max_workers=workers,
+                                              retries=retries)
+            vs_rollbacks = [(vs_name, vs_uuid,
+                             {'json_patch': [{'op': 'replace',
+                                              'path': '/se_group_ref',
+                                              'value': pre}]})
+                            for vs_name, vs_uuid, pre
+                            in journal.rollback_list()]
+
+            def vs_rolled_back(vs_name, vs_uuid, upd, error):
+                if not error:
+                    print(f'Rolled back Virtual Service {vs_name}')
+                    journal.write({'type': 'rolled_back', 'uuid': vs_uuid})
+                else:
+                    print(f'Failed to roll back Virtual Service {vs_name}')
+                    print(f'Error: {error}')
+                    journal.write({'type': 'rollback_failed',
+                                   'uuid': vs_uuid, 'error': error})
+
+            if wave_size or seg_limit:
+                wave_scheduler = WaveScheduler(api, rollback_tenant,
+                                               rollback_executor,
+                                               wave_size or len(vs_rollbacks)
+                                               or 1, seg_limit, timeout,
+                                               poll_interval)
+                wave_scheduler.run(vs_rollbacks, vs_rolled_back)
+            else:
+                wave_scheduler = None
+                rollback_executor.run(vs_rollbacks, vs_rolled_back)
+            journal.close()
+
+            rollback_failures = len(journal.rollback_list())
+            print('Finished.')
+            print(f'{len(vs_rollbacks) - rollback_failures} of '
+                  f'{len(vs_rollbacks)} Virtual Services rolled back.')
+            if wave_scheduler:
+                wave_scheduler.print_summary()
+            rollback_executor.print_stats()
+            exit()
+
         source_seg_obj = api.get_object_by_name('serviceenginegroup',
                                                 source_seg,
                                                 tenant=tenant,
@@ -105,15 +594,32 @@ if __name__ == '__main__':
             ]
         }
 
+        if journal and journal.header and not resume:
+            print(f'Journal {journal_file} already exists. Use --resume to '
+                  f'continue the run or --rollback to undo it.')
+            exit()
+
+        if (resume and journal.header
+                and journal.header['patch_data'] != patch_data):
+            print(f'Journal {journal_file} is for a different change.')
+            exit()
+
+        if journal and not journal.header:
+            journal.write({'type': 'run', 'tenant': tenant,
+                           'patch_data': patch_data,
+                           'wave_size': wave_size, 'seg_limit': seg_limit})
+
         vs_list = api.get_objects_iter('virtualservice', tenant=tenant,
                 params={'refers_to':f'serviceenginegroup:{source_seg_uuid}'})
 
-        successes = 0
-        failures = 0
         skips = 0
 
+        success_list = []
         fail_list = []
 
+        vs_updates = []
+        se_group_refs = {}
+
         for vs in vs_list:
             vs_name = vs['name']
             vs_uuid = vs['uuid']
@@ -128,17 +634,53 @@ if __name__ == '__main__':
                 skips += 1
                 continue
 
-            upd = api.patch(f'virtualservice/{vs_uuid}', tenant=tenant,
-                            data=patch_data)
+            if journal and journal.status(vs_uuid) == 'done':
+                print(f'Skipping VS {vs_name} as it was already updated')
+                skips += 1
+                continue
+
+            se_group_refs[vs_uuid] = vs['se_group_ref']
+            vs_updates.append((vs_name, vs_uuid, patch_data))
 
-            if upd.status_code < 300:
+        def vs_updated(vs_name, vs_uuid, upd, error):
+            if not error:
                 print(f'Updated Virtual Service {vs_name}')
-                successes += 1
+                success_list.append(vs_name)
             else:
                 print(f'Failed to update Virtual Service {vs_name}')
-                print(f'Error: {upd.status_code}: {upd.text}')
+                print(f'Error: {error}')
                 fail_list.append(f'"{vs_name}"')
-                failures += 1
+            if journal:
+                journal.write({'type': 'failed' if error else 'done',
+                               'uuid': vs_uuid, 'error': error,
+                               'status_code': upd.status_code if upd
+                               else None})
+
+        def track(items):
+            # Records the original SE Group of each VS in the journal just
+            # before it is moved
+
+            return (journal.track(items, se_group_refs.get) if journal
+                    else items)
+
+        patch_executor = PatchExecutor(api, tenant, max_workers=workers,
+                                       retries=retries)
+        if wave_size or seg_limit:
+            # With only a limit, all VSs are moved as a single wave
+
+            wave_scheduler = WaveScheduler(api, tenant, patch_executor,
+                                           wave_size or len(vs_updates) or 1,
+                                           seg_limit, timeout, poll_interval)
+            wave_scheduler.run(vs_updates, vs_updated, track)
+        else:
+            wave_scheduler = None
+            patch_executor.run(track(vs_updates), vs_updated)
+
+        if journal:
+            journal.close()
+
+        successes = len(success_list)
+        failures = len(fail_list)
 
         print('Finished.')
         print(f'{successes} Virtual Service{"" if successes == 1 else "s"} '
@@ -150,5 +692,10 @@ if __name__ == '__main__':
         if fail_list:
             print(','.join(fail_list))
 
+        if wave_scheduler:
+            wave_scheduler.print_summary()
+
+        patch_executor.print_stats()
+
     else:
         parser.print_help()
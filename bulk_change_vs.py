@@ -5,6 +5,10 @@ in bulk."""
 
 import argparse
 import getpass
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import requests
 import urllib3
@@ -18,6 +22,264 @@ if hasattr(requests.packages.urllib3, 'disable_warnings'):
 if hasattr(urllib3, 'disable_warnings'):
     urllib3.disable_warnings()
 
+UUID_BATCH_SIZE = 100
+
+
+class PatchExecutor:
+    # Runs PATCH requests concurrently, adapting the number of requests in
+    # flight to the Controller's response: concurrency is increased by one
+    # after each full round of requests that complete without throttling or
+    # a significant rise in latency, and halved on a 429/5xx response or
+    # when latency rises well above its recent average. Transient failures
+    # are retried with exponential backoff. Where the Controller may have
+    # applied a failed request, it is only retried if applying it twice is
+    # harmless.
+
+    RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+    # Responses meaning the request was not processed, so is always safe to
+    # retry
+
+    SAFE_RETRY_STATUS_CODES = {429, 503}
+
+    LATENCY_FACTOR = 3
+    LATENCY_WEIGHT = 0.2
+
+    def __init__(self, api, tenant, max_workers=16, retries=3,
+                 method='patch'):
+        self.api = api
+        self.tenant = tenant
+        self.method = method
+        self.max_workers = max_workers
+        self.retries = retries
+        self.concurrency = min(4, max_workers)
+        self.peak_concurrency = self.concurrency
+        self.avg_latency = None
+        self.since_change = 0
+        self.last_decrease = 0
+        self.latencies = []
+        self.requests = 0
+        self.start_time = None
+
+    def idempotent(self, patch_data):
+        # Whether applying the request twice has the same effect as once: a
+        # PUT, or a PATCH that only replaces or deletes values. Adding to a
+        # list would add a second time.
+
+        if self.method == 'put':
+            return True
+        if isinstance(patch_data, str):
+            try:
+                patch_data = json.loads(patch_data)
+            except json.decoder.JSONDecodeError:
+                return False
+        if not isinstance(patch_data, dict):
+            return False
+        if 'json_patch' in patch_data:
+            return (set(patch_data) == {'json_patch'}
+                    and all(op.get('op') in ('replace', 'test')
+                            for op in patch_data['json_patch']))
+        return set(patch_data) <= {'replace', 'delete'}
+
+    def patch(self, vs_uuid, patch_data):
+        # Returns the final response (or None if the request could not be
+        # made), the error for a failed request, and the (latency, status
+        # code) of each attempt
+
+        idempotent = self.idempotent(patch_data)
+        retry_status_codes = (self.RETRY_STATUS_CODES if idempotent
+                              else self.SAFE_RETRY_STATUS_CODES)
+        attempts = []
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+            start_time = time.perf_counter()
+            try:
+                rsp = getattr(self.api, self.method)(
+                    f'virtualservice/{vs_uuid}', tenant=self.tenant,
+                    data=patch_data)
+            except requests.exceptions.RequestException as ex:
+                attempts.append((time.perf_counter() - start_time, None))
+                rsp, error = None, str(ex)
+                if (idempotent or isinstance(
+                        ex, requests.exceptions.ConnectTimeout)):
+                    continue
+                break
+            attempts.append((time.perf_counter() - start_time,
+                             rsp.status_code))
+            if rsp.status_code < 300:
+                return rsp, None, attempts
+            error = f'{rsp.status_code}: {rsp.text}'
+            if rsp.status_code not in retry_status_codes:
+                break
+        return rsp, error, attempts
+
+    def adapt(self, attempts):
+        # Adjusts concurrency based on the attempts made for one request
+
+        now = time.perf_counter()
+        self.requests += len(attempts)
+        latency, status_code = attempts[-1]
+        throttled = any(a_status is None or a_status == 429
+                        or a_status >= 500 for _, a_status in attempts)
+        slow = (self.avg_latency is not None
+                and latency > self.avg_latency * self.LATENCY_FACTOR)
+        if status_code is not None and status_code < 300:
+            self.latencies.append(latency)
+            if not throttled:
+                # Exponentially weighted moving average, so that a single
+                # unusually fast response does not become the baseline
+
+                self.avg_latency = (latency if self.avg_latency is None
+                                    else self.avg_latency
+                                    + (latency - self.avg_latency)
+                                    * self.LATENCY_WEIGHT)
+
+        if throttled or slow:
+            # Only back off once per round trip, as the requests already in
+            # flight were started at the previous concurrency
+
+            if now - self.last_decrease > latency:
+                self.concurrency = max(1, self.concurrency // 2)
+                self.last_decrease = now
+                self.since_change = 0
+        elif status_code is not None:
+            self.since_change += 1
+            if (self.since_change >= self.concurrency
+                    and self.concurrency < self.max_workers):
+                self.concurrency += 1
+                self.peak_concurrency = max(self.peak_concurrency,
+                                            self.concurrency)
+                self.since_change = 0
+
+    def run(self, items, callback):
+        # Patches each (vs_name, vs_uuid, patch_data) from items, calling
+        # callback(vs_name, vs_uuid, rsp, error) as each request completes
+
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        items = iter(items)
+        running = {}
+        exhausted = False
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                while not exhausted and len(running) < self.concurrency:
+                    item = next(items, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    vs_name, vs_uuid, patch_data = item
+                    running[executor.submit(self.patch, vs_uuid,
+                                            patch_data)] = (vs_name, vs_uuid)
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    vs_name, vs_uuid = running.pop(future)
+                    rsp, error, attempts = future.result()
+                    self.adapt(attempts)
+                    callback(vs_name, vs_uuid, rsp, error)
+
+    def percentile(self, pct):
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * pct / 100))]
+
+    def print_stats(self):
+        if not self.latencies:
+            return
+        elapsed = time.perf_counter() - self.start_time
+        print(f'{len(self.latencies)} updates in {elapsed:.1f}s '
+              f'({len(self.latencies) / elapsed:.1f}/s, '
+              f'{self.requests} requests, peak concurrency '
+              f'{self.peak_concurrency}).')
+        print(f'Latency p50 {self.percentile(50) * 1000:.0f}ms, '
+              f'p90 {self.percentile(90) * 1000:.0f}ms, '
+              f'p99 {self.percentile(99) * 1000:.0f}ms.')
+
+
+class Journal:
+    # An append-only journal of a bulk change run, one JSON record per line.
+    # A 'start' record holding the pre-change value of each VS is written
+    # just before its update is sent, and an outcome record once the update
+    # has completed, so that an interrupted run can be resumed or rolled
+    # back.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.header = None
+        self.vs = {}
+        if os.path.exists(filename):
+            with open(filename, encoding='UTF-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        # A partially written record from an interrupted run
+
+                        continue
+                    self.apply(record)
+
+    def apply(self, record):
+        if record['type'] == 'run':
+            self.header = record
+        elif record['type'] == 'start':
+            self.vs.setdefault(record['uuid'], {'name': record['name'],
+                                                'pre': record['pre'],
+                                                'status': 'pending'})
+        else:
+            self.vs[record['uuid']]['status'] = record['type']
+            self.vs[record['uuid']]['status_code'] = record.get(
+                'status_code')
+
+    def write(self, record):
+        if not self.file:
+            self.file = open(self.filename, 'a+', encoding='UTF-8')
+            if self.file.tell():
+                # Make sure a partially written record is not continued
+
+                self.file.seek(self.file.tell() - 1)
+                if self.file.read(1) != '\n':
+                    self.file.write('\n')
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.apply(record)
+
+    def status(self, vs_uuid):
+        return self.vs.get(vs_uuid, {}).get('status')
+
+    def track(self, items, pre_image):
+        # Yields each (vs_name, vs_uuid, patch_data) from items, first
+        # recording the VS's pre-change value from pre_image(vs_uuid).
+        # Passed to PatchExecutor.run, which takes each item just before
+        # sending its update, so only VSs that are actually sent an update
+        # are recorded. A VS retried on resume keeps its original value.
+
+        for vs_name, vs_uuid, patch_data in items:
+            if not self.status(vs_uuid):
+                self.write({'type': 'start', 'uuid': vs_uuid,
+                            'name': vs_name, 'pre': pre_image(vs_uuid)})
+            yield vs_name, vs_uuid, patch_data
+
+    def rollback_list(self):
+        # VSs that have been (or may have been) changed and not yet rolled
+        # back. A failed update with no response or a 5xx response may
+        # still have been applied by the Controller.
+
+        return [(vs['name'], vs_uuid, vs['pre'])
+                for vs_uuid, vs in self.vs.items()
+                if vs['pre'] is not None
+                and (vs['status'] in ('pending', 'done', 'rollback_failed')
+                     or (vs['status'] == 'failed'
+                         and (vs['status_code'] is None
+                              or vs['status_code'] >= 500)))]
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -29,13 +291,32 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--tenant', help='Tenant',
                         default='admin')
     parser.add_argument('-x', '--apiversion', help='Avi API version')
-    parser.add_argument('patch_data',
-                        help='JSON patch data to apply')
+    parser.add_argument('patch_data', nargs='?',
+                        help='JSON patch data to apply (not required with '
+                             '--rollback)')
     parser.add_argument('-i', '--include',
                         help='Comma-separated list of VSs to include. '
                              'If unspecified, all VSs will be included.')
     parser.add_argument('-e', '--exclude',
                         help='Comma-separated list of VSs to exclude.')
+    parser.add_argument('-w', '--workers',
+                        help='Maximum number of Virtual Services to update '
+                             'concurrently', type=int, default=16)
+    parser.add_argument('-r', '--retries',
+                        help='Number of times to retry a failed update',
+                        type=int, default=3)
+    parser.add_argument('-j', '--journal',
+                        help='Journal file recording the pre-change value '
+                             'and outcome of each update')
+    parser_j = parser.add_mutually_exclusive_group()
+    parser_j.add_argument('--resume',
+                          help='Resume an interrupted run from the journal, '
+                               'skipping VSs that were already updated',
+                          action='store_true')
+    parser_j.add_argument('--rollback',
+                          help='Restore the pre-change value of every VS '
+                               'updated in the journal',
+                          action='store_true')
     parser.add_argument('-f', '--filter',
                         help='Virtual Service object filter string.')
 
@@ -53,6 +334,20 @@ if __name__ == '__main__':
         patch_data = args.patch_data
         vs_include = args.include.split(',') if args.include else None
         vs_exclude = args.exclude.split(',') if args.exclude else None
+        workers = args.workers
+        retries = args.retries
+        journal_file = args.journal
+        resume = args.resume
+        rollback = args.rollback
+
+        if (resume or rollback) and not journal_file:
+            print('A journal file must be specified with -j.')
+            exit()
+
+        if not (patch_data or rollback):
+            print('Patch data must be specified.')
+            exit()
+
         filter_params = ({k: v for k,v in (item.split('=')
                                           for item in args.filter.split('&'))}
                                           if args.filter else {})
@@ -73,15 +368,66 @@ if __name__ == '__main__':
         api = ApiSession.get_session(controller, user, password,
                                      api_version=api_version)
 
+        journal = Journal(journal_file) if journal_file else None
+
+        if rollback:
+            # Replace each VS with its configuration from before the change.
+            # _last_modified is dropped as it is expected to have changed.
+
+            rollback_executor = PatchExecutor(api, journal.header['tenant']
+                                              if journal.header else tenant,
+                                              max_workers=workers,
+                                              retries=retries, method='put')
+            vs_rollbacks = [(vs_name, vs_uuid,
+                             {k: v for k, v in pre.items()
+                              if k != '_last_modified'})
+                            for vs_name, vs_uuid, pre
+                            in journal.rollback_list()]
+
+            def vs_rolled_back(vs_name, vs_uuid, upd, error):
+                if not error:
+                    print(f'Rolled back Virtual Service {vs_name}')
+                    journal.write({'type': 'rolled_back', 'uuid': vs_uuid})
+                else:
+                    print(f'Failed to roll back Virtual Service {vs_name}')
+                    print(f'Error: {error}')
+                    journal.write({'type': 'rollback_failed',
+                                   'uuid': vs_uuid, 'error': error})
+
+            rollback_executor.run(vs_rollbacks, vs_rolled_back)
+            journal.close()
+
+            rollback_failures = len(journal.rollback_list())
+            print('Finished.')
+            print(f'{len(vs_rollbacks) - rollback_failures} of '
+                  f'{len(vs_rollbacks)} Virtual Services rolled back.')
+            rollback_executor.print_stats()
+            exit()
+
+        if journal and journal.header and not resume:
+            print(f'Journal {journal_file} already exists. Use --resume to '
+                  f'continue the run or --rollback to undo it.')
+            exit()
+
+        if (resume and journal.header
+                and journal.header['patch_data'] != patch_data):
+            print(f'Journal {journal_file} is for a different change.')
+            exit()
+
+        if journal and not journal.header:
+            journal.write({'type': 'run', 'tenant': tenant,
+                           'patch_data': patch_data})
+
         vs_list = api.get_objects_iter('virtualservice', tenant=tenant,
                                        params=filter_params)
 
-        successes = 0
-        failures = 0
         skips = 0
 
+        success_list = []
         fail_list = []
 
+        vs_updates = []
+
         for vs in vs_list:
             vs_name = vs['name']
             vs_uuid = vs['uuid']
@@ -96,17 +442,58 @@ if __name__ == '__main__':
                 skips += 1
                 continue
 
-            upd = api.patch(f'virtualservice/{vs_uuid}', tenant=tenant,
-                            data=patch_data)
+            if journal and journal.status(vs_uuid) == 'done':
+                print(f'Skipping VS {vs_name} as it was already updated')
+                skips += 1
+                continue
+
+            vs_updates.append((vs_name, vs_uuid, patch_data))
 
-            if upd.status_code < 300:
+        def vs_updated(vs_name, vs_uuid, upd, error):
+            if not error:
                 print(f'Updated Virtual Service {vs_name}')
-                successes += 1
+                success_list.append(vs_name)
             else:
                 print(f'Failed to update Virtual Service {vs_name}')
-                print(f'Error: {upd.status_code}: {upd.text}')
+                print(f'Error: {error}')
                 fail_list.append(f'"{vs_name}"')
-                failures += 1
+            if journal:
+                journal.write({'type': 'failed' if error else 'done',
+                               'uuid': vs_uuid, 'error': error,
+                               'status_code': upd.status_code if upd
+                               else None})
+
+        vs_positions = {vs_uuid: pos for pos, (_, vs_uuid, _)
+                        in enumerate(vs_updates)}
+        pre_images = {}
+
+        def pre_image(vs_uuid):
+            # The full configuration of a VS before it is changed. This is
+            # fetched separately from the VS list, as a filter may limit
+            # the fields listed, in batches of the VSs about to be updated
+            # so that it is as recent as possible.
+
+            if vs_uuid not in pre_images:
+                pos = vs_positions[vs_uuid]
+                batch = [b_uuid for _, b_uuid, _
+                         in vs_updates[pos:pos + UUID_BATCH_SIZE]]
+                for vs in api.get_objects_iter(
+                        'virtualservice', tenant=tenant,
+                        params={'uuid.in': ','.join(batch),
+                                'page_size': len(batch)}):
+                    pre_images[vs['uuid']] = vs
+            return pre_images.pop(vs_uuid, None)
+
+        patch_executor = PatchExecutor(api, tenant, max_workers=workers,
+                                       retries=retries)
+        patch_executor.run(journal.track(vs_updates, pre_image) if journal
+                           else vs_updates, vs_updated)
+
+        if journal:
+            journal.close()
+
+        successes = len(success_list)
+        failures = len(fail_list)
 
         print('Finished.')
         print(f'{successes} Virtual Service{"" if successes == 1 else "s"} '
@@ -118,5 +505,7 @@ if __name__ == '__main__':
         if fail_list:
             print(','.join(fail_list))
 
+        patch_executor.print_stats()
+
     else:
         parser.print_help()
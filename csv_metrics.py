@@ -4,8 +4,13 @@
 to a CSV file."""
 
 import argparse
+import ast
 import csv
 import getpass
+import heapq
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 
 import requests
@@ -25,6 +30,246 @@ SECONDS_PER_MINUTE = 60
 SECONDS_PER_HOUR = 60 * SECONDS_PER_MINUTE
 SECONDS_PER_DAY = 24 * SECONDS_PER_HOUR
 
+RANK_OBJECT_TYPES = {'vs': 'virtualservice', 'pool': 'pool',
+                     'se': 'serviceengine'}
+
+SUB_OBJECT_TYPES = ('poolserver', 'wafrule', 'wafgroup')
+
+DERIVE_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow)
+
+STATISTICS = {'mean': lambda v: sum(v) / len(v), 'max': max, 'min': min,
+              'sum': sum}
+
+
+def fetch_metric_batch(api, tenant, metric_requests):
+    rsp = api.post('analytics/metrics/collection',
+                   data={'metric_requests': metric_requests}, tenant=tenant)
+    if rsp.status_code >= 300:
+        raise Exception(f'Error retrieving metrics: {rsp.text}')
+    return rsp.json().get('series', {})
+
+
+def rank_entities(api, tenant, entities, base_params, statistic, top_n,
+                  bottom=False, batch_size=100, workers=8):
+    # Entities are split into batches of metric requests which are posted
+    # concurrently. As each batch completes, its values are pushed through
+    # a bounded heap so only the current top (or bottom) N are ever held.
+
+    stat_func = STATISTICS[statistic]
+    sign = -1 if bottom else 1
+    heap = []
+    batches = [entities[i:i + batch_size]
+               for i in range(0, len(entities), batch_size)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_metric_batch, api, tenant,
+                                   [{**base_params, 'entity_uuid': e_uuid}
+                                    for e_uuid in batch])
+                   for batch in batches]
+
+        for future in as_completed(futures):
+            for series_name, series in future.result().items():
+                for metric in series:
+                    values = [d['value'] for d in metric.get('data', [])
+                              if d.get('value') is not None]
+                    if not values:
+                        continue
+                    e_uuid = metric['header'].get('entity_uuid', series_name)
+                    entry = (sign * stat_func(values), e_uuid)
+                    if len(heap) < top_n:
+                        heapq.heappush(heap, entry)
+                    elif entry > heap[0]:
+                        heapq.heapreplace(heap, entry)
+
+    return [(e_uuid, sign * value)
+            for value, e_uuid in sorted(heap, reverse=True)]
+
+
+def operand_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        base = operand_name(node.value)
+        return f'{base}.{node.attr}' if base else None
+    return None
+
+
+def compile_derived(definition):
+    # Parses a "name=expression" definition where the expression is simple
+    # arithmetic over metric Ids (or previously derived names). The
+    # expression is compiled once into a function taking one argument per
+    # operand so it can be applied to whole columns at a time.
+
+    name, _, expression = definition.partition('=')
+    name = name.strip()
+    if not name or not expression.strip():
+        raise ValueError(f'Invalid derived metric "{definition}" - '
+                         f'expected name=expression')
+
+    operands = []
+
+    def rewrite(node):
+        ref = operand_name(node)
+        if ref is not None:
+            if ref not in operands:
+                operands.append(ref)
+            return ast.Name(id=f'_{operands.index(ref)}', ctx=ast.Load())
+        if (isinstance(node, ast.BinOp)
+                and isinstance(node.op, DERIVE_OPERATORS)):
+            node.left = rewrite(node.left)
+            node.right = rewrite(node.right)
+            return node
+        if (isinstance(node, ast.UnaryOp)
+                and isinstance(node.op, (ast.UAdd, ast.USub))):
+            node.operand = rewrite(node.operand)
+            return node
+        if (isinstance(node, ast.Constant)
+                and type(node.value) in (int, float)):
+            return node
+        raise ValueError(f'Unsupported syntax in derived metric "{name}": '
+                         f'{ast.unparse(node)}')
+
+    try:
+        body = rewrite(ast.parse(expression.strip(), mode='eval').body)
+    except SyntaxError as ex:
+        raise ValueError(f'Invalid expression for derived metric '
+                         f'"{name}": {ex.msg}') from ex
+
+    # A constant expression has no columns to be applied to
+
+    if not operands:
+        raise ValueError(f'Derived metric "{name}" must refer to at least '
+                         f'one metric')
+
+    func_def = ast.Expression(ast.Lambda(
+        args=ast.arguments(posonlyargs=[],
+                           args=[ast.arg(arg=f'_{i}')
+                                 for i in range(len(operands))],
+                           kwonlyargs=[], kw_defaults=[], defaults=[]),
+        body=body))
+    func = eval(compile(ast.fix_missing_locations(func_def),
+                        f'<derive {name}>', 'eval'),
+                {'__builtins__': {}})
+    return name, operands, func
+
+
+def derive_column(func, operand_columns):
+    # Any missing operand (or a division by zero) gives a missing result
+    # rather than a misleading value. When the columns are complete the
+    # whole column is mapped in one pass.
+
+    if not any(None in column for column in operand_columns):
+        try:
+            return list(map(func, *operand_columns))
+        except (ZeroDivisionError, OverflowError):
+            pass
+
+    values = []
+    for operand_values in zip(*operand_columns):
+        if None in operand_values:
+            values.append(None)
+            continue
+        try:
+            values.append(func(*operand_values))
+        except (ZeroDivisionError, OverflowError):
+            values.append(None)
+    return values
+
+
+def add_derived_columns(headers, names, columns, derived, num_rows):
+    for name, operands, func in derived:
+        operand_columns = [columns[names.index(o)] if o in names
+                           else [None] * num_rows for o in operands]
+        headers.append(name)
+        names.append(name)
+        columns.append(derive_column(func, operand_columns))
+
+
+def series_table(series, derived=()):
+    headers = ['Timestamp']
+    names = []
+    points = []
+
+    for metric in series:
+        metric_name = metric['header']['name']
+        metric_unit = metric['header']['units']
+        headers.append(f'{metric_name} in {metric_unit}')
+        names.append(metric_name)
+        points.append({data_point['timestamp']: data_point['value']
+                       for data_point in metric.get('data', [])})
+
+    # Align all metrics on the same set of timestamps so that missing data
+    # points (when not padded) are left empty rather than shifting values
+    # into the wrong column.
+
+    timestamps = sorted(set().union(*points))
+    columns = [[p.get(t) for t in timestamps] for p in points]
+    add_derived_columns(headers, names, columns, derived, len(timestamps))
+
+    return headers, [list(row) for row in zip(timestamps, *columns)]
+
+
+def get_sub_object_ids(api, tenant, sub_type, vs_obj=None, pool_obj=None):
+    if sub_type == 'poolserver':
+        servers = api.get_objects_iter(
+            f'pool-inventory/{pool_obj["uuid"]}/server', tenant=tenant)
+        return [f'{ps["config"]["ip"]["addr"]}:{ps["config"]["port"]}'
+                for ps in servers]
+
+    waf_policy_ref = vs_obj.get('waf_policy_ref')
+    if not waf_policy_ref:
+        return []
+    waf_policy = api.get(waf_policy_ref.split('/api/')[1].split('#')[0],
+                         tenant=tenant).json()
+    waf_groups = [g for key in ('pre_crs_groups', 'crs_groups',
+                                'post_crs_groups')
+                  for g in waf_policy.get(key, [])]
+    if sub_type == 'wafgroup':
+        return [g['name'] for g in waf_groups]
+    return [r['rule_id'] for g in waf_groups for r in g.get('rules', [])
+            if 'rule_id' in r]
+
+
+def fetch_sub_object_metrics(api, tenant, base_params, obj_ids,
+                             batch_size=100, workers=8, derived=()):
+    # One metric request is made per sub-object, batched into collection
+    # requests which are posted concurrently. The results are merged into
+    # a single table keyed on (timestamp, obj_id).
+
+    columns = {}
+    output = {}
+    batches = [obj_ids[i:i + batch_size]
+               for i in range(0, len(obj_ids), batch_size)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_metric_batch, api, tenant,
+                                   [{**base_params, 'obj_id': o_id}
+                                    for o_id in batch])
+                   for batch in batches]
+
+        for future in as_completed(futures):
+            for series in future.result().values():
+                for metric in series:
+                    header = metric['header']
+                    column = columns.setdefault(
+                        header['name'],
+                        (len(columns), f'{header["name"]} in '
+                                       f'{header["units"]}'))[0]
+                    o_id = header.get('obj_id', '')
+                    for data_point in metric.get('data', []):
+                        output.setdefault((data_point['timestamp'], o_id),
+                                          {})[column] = data_point['value']
+
+    keys = sorted(output)
+    names = sorted(columns, key=lambda c: columns[c][0])
+    headers = ['Timestamp', 'Object ID', *[columns[c][1] for c in names]]
+    value_columns = [[output[k].get(c) for k in keys]
+                     for c in range(len(columns))]
+    add_derived_columns(headers, names, value_columns, derived, len(keys))
+    output_table = [[*k, *values]
+                    for k, values in zip(keys, zip(*value_columns))]
+    return headers, output_table
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -62,11 +307,47 @@ if __name__ == '__main__':
                         help='Optional object ID - required for metrics that '
                              'relate to specific components such as WAF rule '
                              'or WAF group metrics')
+    parser.add_argument('-so', '--subobjects',
+                        help='Automatically retrieve metrics for all '
+                             'sub-objects of the given type (pool servers '
+                             'of the Pool or WAF rules/groups of the '
+                             'Virtual Service)',
+                        choices=SUB_OBJECT_TYPES)
     parser.add_argument('-ao', '--aggregateobjid',
                         help='Aggregate object IDs', action='store_true')
     parser.add_argument('-pd', '--paddata',
                         help='Pad missing data in the output',
                         action='store_true')
+    parser.add_argument('-d', '--derive',
+                        help='Add a derived metric column as name=expression, '
+                             'e.g. err_rate=l7_client.sum_resp_5xx/'
+                             'l7_client.sum_total_responses. May be repeated.',
+                        action='append', default=[])
+    parser.add_argument('-fo', '--follow',
+                        help='Keep polling for new data points and output '
+                             'them as they arrive',
+                        action='store_true')
+    parser.add_argument('-r', '--rank',
+                        help='Rank all objects of the given type by the '
+                             'first metric Id',
+                        choices=RANK_OBJECT_TYPES.keys())
+    parser.add_argument('-n', '--top',
+                        help='Number of objects to include in the ranking',
+                        type=int, default=20)
+    parser.add_argument('-b', '--bottom',
+                        help='Rank the lowest values rather than highest',
+                        action='store_true')
+    parser.add_argument('-s', '--statistic',
+                        help='Statistic used to rank objects over the '
+                             'timespan',
+                        choices=STATISTICS.keys(), default='mean')
+    parser.add_argument('-w', '--workers',
+                        help='Number of concurrent metrics requests '
+                             '(ranking and sub-object modes)',
+                        type=int, default=8)
+    parser.add_argument('-bs', '--batchsize',
+                        help='Number of objects per metrics request',
+                        type=int, default=100)
 
     args = parser.parse_args()
 
@@ -95,7 +376,28 @@ if __name__ == '__main__':
         history = args.history
         csv_filename = args.file
         obj_id = args.objid
+        sub_type = args.subobjects
         pad_data = args.paddata
+        follow = args.follow
+
+        try:
+            derived = [compile_derived(d) for d in args.derive]
+        except ValueError as ex:
+            print(ex)
+            exit()
+
+        # Make sure every metric used by a derived expression is retrieved
+
+        derived_names = [d[0] for d in derived]
+        metrics = list(dict.fromkeys(metrics + [o for d in derived
+                                                for o in d[1]
+                                                if o not in derived_names]))
+        rank_type = args.rank
+        top_n = args.top
+        bottom = args.bottom
+        statistic = args.statistic
+        workers = args.workers
+        batch_size = args.batchsize
 
         if history[-1] == 'm':
             history = int(history[:-1]) * SECONDS_PER_MINUTE
@@ -108,6 +410,11 @@ if __name__ == '__main__':
 
         limit = history // granularity
 
+        if follow and (rank_type or sub_type):
+            print('Follow mode is not supported with ranking or '
+                  'sub-objects')
+            exit()
+
         while not controller:
             controller = input('Controller:')
 
@@ -124,6 +431,44 @@ if __name__ == '__main__':
         api = ApiSession.get_session(controller, user, password,
                                      api_version=api_version)
 
+        if rank_type:
+            # Rank every object of the requested type by a single metric
+
+            metric_id = metrics[0]
+            entities = {e['uuid']: e['name'] for e in api.get_objects_iter(
+                            RANK_OBJECT_TYPES[rank_type], tenant=tenant,
+                            params={'fields': 'name,uuid'})}
+
+            print(f'Ranking {len(entities)} objects by {statistic} '
+                  f'{metric_id}...')
+
+            start_time = time.perf_counter()
+            ranking = rank_entities(api, tenant, list(entities),
+                                    {'stop': end, 'step': granularity,
+                                     'limit': limit, 'metric_id': metric_id,
+                                     'pad_missing_data': False},
+                                    statistic, top_n, bottom=bottom,
+                                    batch_size=batch_size, workers=workers)
+            print(f'Ranked in {time.perf_counter() - start_time:.2f}s')
+
+            headers = ['Rank', 'Name', 'UUID', f'{statistic} {metric_id}']
+            output_table = [[index, entities.get(e_uuid, e_uuid), e_uuid,
+                             value]
+                            for index, (e_uuid, value) in enumerate(ranking,
+                                                                    start=1)]
+
+            if csv_filename:
+                print(f'Writing to {csv_filename}')
+                with open(csv_filename, 'w',
+                          newline='', encoding='UTF-8') as csv_file:
+                    csv_writer = csv.writer(csv_file, dialect='excel')
+                    csv_writer.writerow(headers)
+                    csv_writer.writerows(output_table)
+            else:
+                print(tabulate(output_table, headers=headers,
+                               tablefmt='outline'))
+            exit()
+
         if se:
             se_obj = api.get_object_by_name('serviceengine', se, tenant=tenant)
 
@@ -175,17 +520,53 @@ if __name__ == '__main__':
             print('Unsupported combination of options')
             exit()
 
+        if sub_type:
+            if sub_type == 'poolserver' and not pool:
+                print('A Pool must be specified to retrieve pool server '
+                      'metrics')
+                exit()
+            if sub_type != 'poolserver' and not vs:
+                print('A Virtual Service must be specified to retrieve WAF '
+                      'metrics')
+                exit()
+
+            obj_ids = get_sub_object_ids(api, tenant, sub_type,
+                                         vs_obj=vs_obj if vs else None,
+                                         pool_obj=pool_obj if pool else None)
+
+            if not obj_ids:
+                print(f'No {sub_type} objects were found')
+                exit()
+
+            print(f'Retrieving metrics for {len(obj_ids)} {sub_type} '
+                  f'objects...')
+
+            headers, output_table = fetch_sub_object_metrics(
+                api, tenant, params, obj_ids, batch_size=batch_size,
+                workers=workers, derived=derived)
+
+            if not output_table:
+                print('No data was returned - did you get a parameter wrong?')
+                exit()
+
+            if csv_filename:
+                print(f'Writing to {csv_filename}')
+                with open(csv_filename, 'w',
+                          newline='', encoding='UTF-8') as csv_file:
+                    csv_writer = csv.writer(csv_file, dialect='excel')
+                    csv_writer.writerow(headers)
+                    csv_writer.writerows(output_table)
+            else:
+                print(tabulate(output_table, headers=headers,
+                               tablefmt='outline'))
+            exit()
+
         if obj_id:
             params['obj_id'] = obj_id
             if agg_objid:
                 params['aggregate_obj_id'] = True
 
-        data = {'metric_requests': [params]}
-
-        metrics = api.post('analytics/metrics/collection',
-                           data=data, tenant=tenant).json()
-
-        series_data = metrics.get('series', {})
+        series_data = fetch_metric_batch(api, tenant, [params])
 
         num_series = len(series_data)
 
@@ -194,21 +575,7 @@ if __name__ == '__main__':
             exit()
 
         for index, (series_name, series) in enumerate(series_data.items()):
-            headers = ['Timestamp']
-            output = {}
-
-            for metric in series:
-                metric_name = metric['header']['name']
-                metric_unit = metric['header']['units']
-                headers.append(f'{metric_name} in {metric_unit}')
-                data = metric.get('data', [])
-                for data_point in data:
-                    timestamp = data_point['timestamp']
-                    if timestamp not in output:
-                        output[timestamp] = []
-                    output[timestamp].append(data_point['value'])
-
-            output_table = [[k, *output[k]] for k in sorted(output)]
+            headers, output_table = series_table(series, derived)
 
             if csv_filename:
                 print(f'Writing to {csv_filename} for series {series_name}')
@@ -224,5 +591,45 @@ if __name__ == '__main__':
                 print(f'Series {series_name}:')
                 print(tabulate(output_table, headers=headers,
                             tablefmt='outline'))
+
+        if follow:
+            if num_series > 1:
+                print('Follow mode is only supported for a single series')
+                exit()
+
+            # Keep the session open and only ask for data points after the
+            # last timestamp we received. The most recent window is held in
+            # a ring buffer for on-screen display.
+
+            window = deque(output_table, maxlen=max(limit, 1))
+            last_timestamp = output_table[-1][0] if output_table else end
+            params.pop('stop', None)
+
+            try:
+                while True:
+                    time.sleep(granularity)
+                    params['start'] = last_timestamp
+                    series_data = fetch_metric_batch(api, tenant, [params])
+                    new_rows = [row for series in series_data.values()
+                                for row in series_table(series, derived)[1]
+                                if row[0] > last_timestamp]
+                    if not new_rows:
+                        continue
+                    last_timestamp = new_rows[-1][0]
+
+                    if csv_filename:
+                        with open(csv_filename, 'a',
+                                  newline='', encoding='UTF-8') as csv_file:
+                            csv_writer = csv.writer(csv_file, dialect='excel')
+                            csv_writer.writerows(new_rows)
+                        print(f'Appended {len(new_rows)} rows up to '
+                              f'{last_timestamp}')
+                    else:
+                        window.extend(new_rows)
+                        print('\033[H\033[J', end='')
+                        print(tabulate(list(window), headers=headers,
+                                       tablefmt='outline'))
+            except KeyboardInterrupt:
+                print('Stopped following metrics.')
     else:
         parser.print_help()
@@ -5,6 +5,13 @@
 import argparse
 import csv
 import getpass
+import json
+import os
+import time
+from bisect import bisect_right
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import count
 
 import requests
 import urllib3
@@ -19,6 +26,701 @@ if hasattr(requests.packages.urllib3, 'disable_warnings'):
 if hasattr(urllib3, 'disable_warnings'):
     urllib3.disable_warnings()
 
+PAGE_SIZE = 100
+UUID_BATCH_SIZE = 100
+
+# Each column is described by the inventory sections it needs, the config
+# object fields it needs (None if it can only come from the inventory API)
+# and the function that produces its value from an inventory object and
+# any additional per-object context.
+
+VS_COLUMNS = {
+    'Name': ({'config'}, 'name',
+             lambda vs, ctx: vs['config']['name']),
+    'UUID': ({'config'}, 'uuid',
+             lambda vs, ctx: vs['config']['uuid']),
+    'Tenant': ({'config'}, 'tenant_ref',
+               lambda vs, ctx: ref_name(vs['config']['tenant_ref'])),
+    'Cloud': ({'config'}, 'cloud_ref',
+              lambda vs, ctx: ref_name(vs['config']['cloud_ref'])),
+    'VRF': ({'config'}, 'vrf_context_ref',
+            lambda vs, ctx: ref_name(vs['config']['vrf_context_ref'])),
+    'Type': ({'config'}, 'type',
+             lambda vs, ctx: vs['config']['type'].split('VS_TYPE_')[1]),
+    'SEG': ({'config'}, 'se_group_ref',
+            lambda vs, ctx: ref_name(vs['config']['se_group_ref'])),
+    'VIPs': ({'config', 'parent_vs_vip'}, None,
+             lambda vs, ctx: ','.join(vs_ip_addresses(vs))),
+    'FQDNs': ({'config'}, None,
+              lambda vs, ctx: vs_fqdns(vs)),
+    'Ports': ({'config'}, 'services',
+              lambda vs, ctx: vs_ports(vs)),
+    'Pools': ({'pools'}, None,
+              lambda vs, ctx: ','.join([ref_name(p) for p in vs['pools']])),
+    'Pool Groups': ({'poolgroups'}, None,
+                    lambda vs, ctx: ','.join([ref_name(pg)
+                                              for pg in vs['poolgroups']])),
+    'App Type': ({'app_profile_type'}, None,
+                 lambda vs, ctx: vs.get(
+                     'app_profile_type', 'APPLICATION_PROFILE_TYPE_UNKNOWN'
+                 ).split('APPLICATION_PROFILE_TYPE_')[1]),
+    'WAF': ({'config'}, 'waf_policy_ref',
+            lambda vs, ctx: vs['config'].get('waf_policy_ref',
+                                             '#').split('#')[1]),
+    'State': ({'config'}, 'enabled',
+              lambda vs, ctx: ('Enabled' if vs['config']['enabled']
+                               else 'Disabled')),
+    'Oper State': ({'runtime'}, None,
+                   lambda vs, ctx: oper_state(vs)),
+    'Health Score': ({'health_score'}, None,
+                     lambda vs, ctx: vs['health_score']['health_score']),
+    'Service Engines': ({'runtime'}, None,
+                        lambda vs, ctx: ','.join(vs_se_list(vs)))}
+
+POOL_COLUMNS = {
+    'Name': ({'config'}, 'name',
+             lambda p, ctx: p['config']['name']),
+    'UUID': ({'config'}, 'uuid',
+             lambda p, ctx: p['config']['uuid']),
+    'Tenant': ({'config'}, 'tenant_ref',
+               lambda p, ctx: ref_name(p['config']['tenant_ref'])),
+    'Cloud': ({'config'}, 'cloud_ref',
+              lambda p, ctx: ref_name(p['config']['cloud_ref'])),
+    'VRF': ({'config'}, 'vrf_ref',
+            lambda p, ctx: ref_name(p['config']['vrf_ref'])),
+    'Port': ({'config'}, 'default_server_port',
+             lambda p, ctx: p['config']['default_server_port']),
+    '#Servers': ({'config'}, None,
+                 lambda p, ctx: p['config']['num_servers']),
+    'State': ({'runtime'}, None,
+              lambda p, ctx: oper_state(p)),
+    'Health Score': ({'health_score'}, None,
+                     lambda p, ctx: p['health_score']['health_score']),
+    'Virtual Services': ({'virtualservices'}, None,
+                         lambda p, ctx: ','.join(
+                             [ref_name(vs)
+                              for vs in p.get('virtualservices', [])])),
+    'Servers': ({'config'}, None,
+                lambda p, ctx: pool_servers(p, ctx['servers'])),
+    'Service Engines': ({'virtualservices'}, None,
+                        lambda p, ctx: ','.join(set().union(
+                            *[ctx['vs_selists'].get(vs_uuid, ())
+                              for vs_uuid in pool_vs_uuids(p)])))}
+
+SE_COLUMNS = {
+    'Name': ({'config'}, 'name',
+             lambda s, ctx: s['config']['name']),
+    'UUID': ({'config'}, 'uuid',
+             lambda s, ctx: s['config']['uuid']),
+    'Tenant': ({'config'}, 'tenant_ref',
+               lambda s, ctx: ref_name(s['config']['tenant_ref'])),
+    'Cloud': ({'config'}, 'cloud_ref',
+              lambda s, ctx: ref_name(s['config']['cloud_ref'])),
+    'SEG': ({'config'}, 'se_group_ref',
+            lambda s, ctx: ref_name(s['config']['se_group_ref'])),
+    'State': ({'config'}, 'enable_state',
+              lambda s, ctx: s['config']['enable_state'].split(
+                  'SE_STATE_')[1]),
+    'Oper State': ({'runtime'}, None,
+                   lambda s, ctx: oper_state(s)),
+    'Connectivity': ({'runtime'}, None,
+                     lambda s, ctx: ('Connected'
+                                     if s['runtime']['se_connected']
+                                     else 'Not connected')),
+    'Version': ({'runtime'}, None,
+                lambda s, ctx: s['runtime']['version']),
+    'Online Since': ({'runtime'}, None,
+                     lambda s, ctx: s['runtime']['online_since']),
+    'Health Score': ({'health_score'}, None,
+                     lambda s, ctx: s['health_score']['health_score']),
+    'Virtual Services': ({'config'}, None,
+                         lambda s, ctx: ','.join(
+                             [ref_name(v)
+                              for v in s['config']['virtualservice_refs']])),
+    'vCPUs': (set(), None,
+              lambda s, ctx: ctx['resources'].get('num_vcpus', '-')),
+    'Memory (MB)': (set(), None,
+                    lambda s, ctx: ctx['resources'].get('memory', '-')),
+    'Disk (GB)': (set(), None,
+                  lambda s, ctx: ctx['resources'].get('disk', '-')),
+    'QAT Mode': (set(), None,
+                 lambda s, ctx: ctx['resources'].get(
+                     'qat_mode', 'QAT_N/A').split('QAT_')[1])}
+
+VS_HEADERS = list(VS_COLUMNS)
+POOL_DETAIL_HEADERS = ['Servers', 'Service Engines']
+POOL_HEADERS = [c for c in POOL_COLUMNS if c not in POOL_DETAIL_HEADERS]
+SE_DETAIL_HEADERS = ['vCPUs', 'Memory (MB)', 'Disk (GB)', 'QAT Mode']
+SE_HEADERS = [c for c in SE_COLUMNS if c not in SE_DETAIL_HEADERS]
+
+# Inventory type: (config object type, column definitions, default columns)
+
+INVENTORY_TYPES = {'vs': ('virtualservice', VS_COLUMNS, VS_HEADERS),
+                   'pool': ('pool', POOL_COLUMNS, POOL_HEADERS),
+                   'pooldetail': ('pool', POOL_COLUMNS,
+                                  POOL_HEADERS + POOL_DETAIL_HEADERS),
+                   'se': ('serviceengine', SE_COLUMNS, SE_HEADERS),
+                   'sedetail': ('serviceengine', SE_COLUMNS,
+                                SE_HEADERS + SE_DETAIL_HEADERS)}
+
+CONFLICT_HEADERS = ['Conflict', 'VRF', 'Address', 'Port(s)', 'Objects']
+CAPACITY_HEADERS = ['Service Engine', 'SEG', 'Oper State', 'vCPUs',
+                    'Memory (MB)', '#VSs', 'VSs per vCPU',
+                    'SEG Avg VSs per vCPU', 'Hot Spot']
+
+# Columns refreshed for unchanged objects in delta mode: runtime and health
+# columns, and columns derived from other objects (which can change without
+# the object's own _last_modified changing)
+
+DELTA_TYPES = {'vs': ['VIPs', 'Pools', 'Pool Groups', 'App Type',
+                      'Oper State', 'Health Score', 'Service Engines'],
+               'pool': ['State', 'Health Score', 'Virtual Services'],
+               'se': ['Oper State', 'Connectivity', 'Version',
+                      'Online Since', 'Health Score', 'Virtual Services']}
+
+
+def ref_name(ref):
+    return ref.split('#')[1]
+
+
+def oper_state(obj):
+    return obj['runtime']['oper_status']['state'].split('OPER_')[1]
+
+
+def vs_se_list(vs):
+    vs_selist = set()
+    for v in vs.get('runtime', {}).get('vip_summary', []):
+        if 'service_engine' in v:
+            vs_selist.update(s['url'].split('#')[1]
+                             for s in v['service_engine'])
+    return vs_selist
+
+
+def ip_addresses(vips):
+    return [v[ip_type]['addr'] for v in vips
+            for ip_type in ('ip_address', 'ip6_address') if ip_type in v]
+
+
+def vs_ip_addresses(vs):
+    if vs['config']['type'] == 'VS_TYPE_VH_CHILD':
+        return ip_addresses(vs.get('parent_vs_vip', []))
+    return ip_addresses(vs['config'].get('vip', []))
+
+
+def vs_fqdns(vs):
+    vs_config = vs['config']
+    if vs_config['type'] == 'VS_TYPE_VH_CHILD':
+        return ','.join(vs_config.get('vh_domain_name', []))
+    return ','.join([d['fqdn'] for d in vs_config.get('dns_info', [])])
+
+
+def vs_ports(vs):
+    ports = [(s['port'], s['port_range_end'], s['enable_ssl'])
+             for s in vs['config']['services']]
+    return ','.join([f'{a}' + ('' if a == b else f'-{b}') +
+                     ('*' if c else '')
+                     for (a, b, c) in ports])
+
+
+def pool_vs_uuids(p):
+    return [vs.split('/api/virtualservice/')[1].split('#')[0]
+            for vs in p.get('virtualservices', [])]
+
+
+def pool_servers(p, ps_inventory):
+    p_port = p['config']['default_server_port']
+    p_servers = [(ps['config']['ip']['addr'],
+                  ps['config']['port'],
+                  oper_state(ps),
+                  ps['health_score']['health_score'])
+                 for ps in ps_inventory]
+    return ','.join([f'{a}' + (f':{b}' if b != p_port else '') +
+                     f' [{c},{d}]' for (a, b, c, d) in p_servers])
+
+
+def parse_columns(inventory_type, columns):
+    # Returns the requested column names in the canonical spelling for the
+    # inventory type, or the default columns if none were requested
+
+    _, column_defs, default_columns = INVENTORY_TYPES[inventory_type]
+    if not columns:
+        return list(default_columns)
+    available = {c.lower(): c for c in default_columns}
+    selected = []
+    for column in columns.split(','):
+        if column.strip().lower() not in available:
+            raise ValueError(f'Unknown column "{column}" for {inventory_type} '
+                             f'inventory. Available columns are: '
+                             f'{", ".join(default_columns)}')
+        selected.append(available[column.strip().lower()])
+    return selected
+
+
+class InventoryCollector:
+    def __init__(self, api, tenant, workers=8, serial=False):
+        self.api = api
+        self.tenant = tenant
+        self.workers = workers
+        self.serial = serial
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.stream_executor = ThreadPoolExecutor()
+        self.shared_vs_selists = None
+
+    def close(self):
+        self.stream_executor.shutdown()
+        self.executor.shutdown()
+
+    def submit_stream(self, func, *args):
+        # Whole inventory streams run on their own executor so that their
+        # page requests can never be starved by the stream that needs them
+
+        if self.serial:
+            future = Future()
+            future.set_result(func(*args))
+            return future
+        return self.stream_executor.submit(func, *args)
+
+    def get_page(self, path, params, page):
+        rsp = self.api.get(path, tenant=self.tenant,
+                           params={**params, 'page': page})
+        if rsp.status_code >= 300:
+            raise Exception(f'Error retrieving {path}: {rsp.text}')
+        return rsp.json()
+
+    def get_inventory(self, path, params=None):
+        # Yields every object from a collection. The first page gives the
+        # total count, after which all remaining pages are requested
+        # concurrently. Pages are yielded in order as soon as each one (and
+        # all pages before it) has arrived, so output order is unchanged.
+
+        params = {'include_name': True, **(params or {})}
+
+        if self.serial:
+            yield from self.api.get_objects_iter(path, tenant=self.tenant,
+                                                 params=params)
+            return
+
+        params['page_size'] = PAGE_SIZE
+        first_page = self.get_page(path, params, 1)
+        results = first_page.get('results', [])
+        yield from results
+
+        num_pages = -(-first_page.get('count', len(results)) // PAGE_SIZE)
+        futures = [self.executor.submit(self.get_page, path, params, page)
+                   for page in range(2, num_pages + 1)]
+        for future in futures:
+            yield from future.result().get('results', [])
+
+    def map_ordered(self, func, items):
+        # Applies func to each item concurrently, yielding results in the
+        # original order as they become available
+
+        if self.serial:
+            return map(func, items)
+        return self.executor.map(func, items)
+
+    def get_by_uuids(self, path, uuids, params=None):
+        # Retrieve the given objects in batches using uuid.in, yielding them
+        # in batch order
+
+        batches = [uuids[i:i + UUID_BATCH_SIZE]
+                   for i in range(0, len(uuids), UUID_BATCH_SIZE)]
+
+        def fetch_batch(batch):
+            return list(self.api.get_objects_iter(
+                path, params={'include_name': True, **(params or {}),
+                              'uuid.in': ','.join(batch),
+                              'page_size': len(batch)},
+                tenant=self.tenant))
+
+        for batch in self.map_ordered(fetch_batch, batches):
+            yield from batch
+
+    def get_vs_se_lists(self, vs_uuids):
+        # Returns a mapping of VS UUID to the set of SE names
+
+        return {vs['config']['uuid']: vs_se_list(vs)
+                for vs in self.get_by_uuids('virtualservice-inventory',
+                                            vs_uuids,
+                                            {'fields': 'config,runtime'})}
+
+    def get_objects(self, inventory_type, columns, uuids=None):
+        # Retrieve only what the selected columns need. If every column can
+        # be produced from config object fields, the (much lighter) config
+        # API is queried for just those fields; otherwise the inventory API
+        # is asked for just the required sections.
+
+        config_path, column_defs, default_columns = (
+            INVENTORY_TYPES[inventory_type])
+        config_fields = [column_defs[c][1] for c in columns]
+
+        if all(config_fields):
+            params = {'fields': ','.join(dict.fromkeys(config_fields))}
+            path = config_path
+            wrap = True
+        else:
+            sections = set().union(*[column_defs[c][0] for c in columns])
+            all_sections = set().union(*[column_defs[c][0]
+                                         for c in default_columns])
+            params = ({'fields': ','.join(sorted(sections | {'config'}))}
+                      if sections < all_sections else {})
+            path = f'{config_path}-inventory'
+            wrap = False
+
+        if uuids is None:
+            objects = self.get_inventory(path, params)
+        else:
+            objects = self.get_by_uuids(path, uuids, params)
+
+        for obj in objects:
+            yield {'config': obj} if wrap else obj
+
+    def inventory(self, inventory_type, columns=None):
+        columns = columns or list(INVENTORY_TYPES[inventory_type][2])
+        if inventory_type in ('pool', 'pooldetail'):
+            return self.pool_inventory(columns)
+        if inventory_type in ('se', 'sedetail'):
+            return self.se_inventory(columns)
+        return self.vs_inventory(columns)
+
+    def collect(self, inventory_types, columns=None):
+        # Collects several inventory types at once, each as its own
+        # concurrent stream. When the VS inventory (with its SE lists) is
+        # being collected anyway, the pool inventory reuses its VS to SE
+        # mapping rather than fetching the VS inventory again.
+
+        columns = columns or {}
+        inventory_types = sorted(inventory_types,
+                                 key=list(INVENTORY_TYPES).index)
+        vs_columns = columns.get('vs', VS_HEADERS)
+
+        if ('vs' in inventory_types and 'Service Engines' in vs_columns
+                and any('Service Engines' in columns.get(
+                            t, INVENTORY_TYPES[t][2])
+                        for t in ('pool', 'pooldetail')
+                        if t in inventory_types)):
+            self.shared_vs_selists = Future()
+
+        futures = {t: self.submit_stream(self.inventory, t, columns.get(t))
+                   for t in inventory_types}
+
+        if self.shared_vs_selists is not None:
+            def share_failure(future):
+                if (future.exception() is not None
+                        and not self.shared_vs_selists.done()):
+                    self.shared_vs_selists.set_exception(future.exception())
+            futures['vs'].add_done_callback(share_failure)
+
+        return {t: futures[t].result() for t in inventory_types}
+
+    def vs_inventory(self, columns=VS_HEADERS):
+        vs_inventory = list(self.get_objects('vs', columns))
+
+        if (self.shared_vs_selists is not None
+                and not self.shared_vs_selists.done()):
+            self.shared_vs_selists.set_result(
+                {vs['config']['uuid']: vs_se_list(vs)
+                 for vs in vs_inventory})
+
+        output_table = build_rows(vs_inventory, VS_COLUMNS, columns)
+        return list(columns), output_table
+
+    def pool_inventory(self, columns=POOL_HEADERS):
+        p_inventory = list(self.get_objects('pooldetail', columns))
+        contexts = [{} for _ in p_inventory]
+
+        if 'Service Engines' in columns:
+            # Prefetch the inventory of every VS referenced by any pool
+            # once, in batches, rather than once per referencing pool
+            # (unless the full VS inventory is being collected already)
+
+            if self.shared_vs_selists is not None:
+                vs_selists = self.shared_vs_selists.result()
+            else:
+                vs_uuids = list(dict.fromkeys(
+                    vs_uuid for p in p_inventory
+                    for vs_uuid in pool_vs_uuids(p)))
+                vs_selists = self.get_vs_se_lists(vs_uuids)
+            for ctx in contexts:
+                ctx['vs_selists'] = vs_selists
+
+        if 'Servers' in columns:
+            # Pool server lists are fetched concurrently
+
+            ps_inventories = self.map_ordered(
+                lambda p: list(self.api.get_objects_iter(
+                    f'pool-inventory/{p["config"]["uuid"]}/server',
+                    params={'include_name': True},
+                    tenant=self.tenant)),
+                p_inventory)
+            for ctx, ps_inventory in zip(contexts, ps_inventories):
+                ctx['servers'] = ps_inventory
+
+        output_table = build_rows(p_inventory, POOL_COLUMNS, columns,
+                                  contexts)
+        return list(columns), output_table
+
+    def se_inventory(self, columns=SE_HEADERS):
+        detail = any(c in SE_DETAIL_HEADERS for c in columns)
+
+        if detail:
+            # SE resources are collected alongside the SE inventory
+
+            s_details = self.submit_stream(
+                lambda: {s['uuid']: s['resources']
+                         for s in self.get_inventory(
+                             'serviceengine', {'fields': 'resources'})})
+
+        s_inventory = list(self.get_objects('sedetail', columns))
+
+        if detail:
+            s_details = s_details.result()
+            contexts = [{'resources': s_details.get(s['config']['uuid'], {})}
+                        for s in s_inventory]
+        else:
+            contexts = None
+
+        output_table = build_rows(s_inventory, SE_COLUMNS, columns, contexts)
+        return list(columns), output_table
+
+    def delta_inventory(self, inventory_type, snapshot, columns=None):
+        # A lightweight projected query of the config objects gives the
+        # _last_modified time of every object. Only new or modified objects
+        # have their full inventory retrieved; unchanged objects reuse the
+        # snapshot row and just have the columns in DELTA_TYPES refreshed.
+        # Deleted objects are detected by their absence.
+
+        config_path, column_defs, default_columns = (
+            INVENTORY_TYPES[inventory_type])
+        columns = columns or list(default_columns)
+        runtime_columns = [c for c in DELTA_TYPES[inventory_type]
+                           if c in columns]
+        previous = snapshot.get('objects', {})
+
+        current = [(o['uuid'], o.get('name', ''), o.get('_last_modified'))
+                   for o in self.get_inventory(
+                       config_path, {'fields': 'name,_last_modified'})]
+        changed = [o_uuid for o_uuid, _, last_modified in current
+                   if o_uuid not in previous or last_modified is None
+                   or previous[o_uuid]['fingerprint'] != last_modified]
+        changed_set = set(changed)
+        unchanged = [o_uuid for o_uuid, _, _ in current
+                     if o_uuid not in changed_set]
+
+        # Retrieve changed objects via get_objects so that the rows match a
+        # full run exactly; UUID must be available to match them up again
+
+        fetch_columns = columns if 'UUID' in columns else ['UUID', *columns]
+        fetched = self.submit_stream(
+            lambda: {o['config']['uuid']: build_rows([o], column_defs,
+                                                     columns)[0]
+                     for o in self.get_objects(inventory_type,
+                                               fetch_columns, changed)})
+        runtime = {}
+        if runtime_columns:
+            # config is always requested so that every object has the
+            # same shape and can be matched up by its config UUID
+
+            sections = set().union(*[column_defs[c][0]
+                                     for c in runtime_columns])
+            for o in self.get_by_uuids(
+                    f'{config_path}-inventory', unchanged,
+                    {'fields': ','.join(sorted(sections | {'config'}))}):
+                o_uuid = o['config']['uuid']
+                runtime[o_uuid] = {c: column_defs[c][2](o, {})
+                                   for c in runtime_columns}
+        fetched = fetched.result()
+
+        objects = {}
+        changes = []
+        output_table = []
+
+        for o_uuid, o_name, last_modified in current:
+            if o_uuid in fetched:
+                row = fetched[o_uuid]
+                changes.append(['Modified' if o_uuid in previous else 'Added',
+                                o_name, o_uuid])
+            elif o_uuid in previous:
+                row = list(previous[o_uuid]['row'])
+                for column, value in runtime.get(o_uuid, {}).items():
+                    row[columns.index(column)] = value
+            else:
+                # Object was deleted between the two passes
+                continue
+            objects[o_uuid] = {'fingerprint': last_modified, 'name': o_name,
+                               'row': row}
+            output_table.append(row)
+
+        changes.extend(['Deleted', o.get('name', ''), o_uuid]
+                       for o_uuid, o in previous.items()
+                       if o_uuid not in objects)
+
+        new_snapshot = {'inventory_type': inventory_type,
+                        'tenant': self.tenant, 'columns': columns,
+                        'objects': objects}
+        return list(columns), output_table, changes, new_snapshot
+
+    def conflict_analysis(self):
+        # VS VIPs and services come from the inventory (which resolves the
+        # VIPs of VH children and VsVip references), while pool servers
+        # come from the config API in one paged pass rather than one call
+        # per pool. Both are retrieved concurrently.
+
+        vs_objects = self.submit_stream(
+            lambda: list(self.get_inventory('virtualservice-inventory',
+                                            {'fields': 'config,'
+                                                       'parent_vs_vip'})))
+        pool_objects = list(self.get_inventory(
+            'pool', {'fields': 'name,uuid,vrf_ref,default_server_port,'
+                               'servers'}))
+        return CONFLICT_HEADERS, find_conflicts(vs_objects.result(),
+                                                pool_objects)
+
+    def capacity_analysis(self, hotspot_factor=1.5):
+        # The VS inventory (for placement), SE inventory (for SE Group and
+        # state) and SE resources are retrieved as three concurrent streams
+
+        vs_objects = self.submit_stream(
+            lambda: list(self.get_objects('vs', ['Name',
+                                                 'Service Engines'])))
+        se_resources = self.submit_stream(
+            lambda: {s['uuid']: s.get('resources', {})
+                     for s in self.get_inventory(
+                         'serviceengine', {'fields': 'resources'})})
+        se_objects = list(self.get_objects('se', ['Name', 'SEG',
+                                                  'Oper State']))
+        return CAPACITY_HEADERS, find_capacity(vs_objects.result(),
+                                               se_objects,
+                                               se_resources.result(),
+                                               hotspot_factor)
+
+
+def find_conflicts(vs_objects, pool_objects):
+    # Addresses are indexed by (VRF, IP). Each VIP entry holds the sorted
+    # port ranges of the VSs using it so overlaps can be found with a single
+    # sweep, and pool servers are matched against the VIP index with a
+    # binary search, giving O(n log n) overall rather than pairwise
+    # comparison of every address.
+
+    conflicts = []
+    vip_index = defaultdict(list)
+    ip_vrfs = defaultdict(set)
+    vrf_names = {}
+
+    for vs in vs_objects:
+        vs_config = vs['config']
+        if vs_config['type'] == 'VS_TYPE_VH_CHILD':
+            # Children share their parent's VIP by design
+            continue
+        vrf = vs_config['vrf_context_ref']
+        vrf_names[vrf] = ref_name(vrf)
+        ports = [(svc['port'], svc['port_range_end'])
+                 for svc in vs_config.get('services', [])]
+        for ip in set(vs_ip_addresses(vs)):
+            ip_vrfs[ip].add(vrf)
+            vip_index[(vrf, ip)].extend(
+                (start, end, vs_config['name']) for start, end in ports)
+
+    for (vrf, ip), ranges in vip_index.items():
+        ranges.sort()
+        max_end, max_vs = -1, None
+        for start, end, vs_name in ranges:
+            if start <= max_end and vs_name != max_vs:
+                conflicts.append(['Duplicate VIP', vrf_names[vrf], ip,
+                                  f'{start}-{min(end, max_end)}',
+                                  f'{max_vs},{vs_name}'])
+            if end > max_end:
+                max_end, max_vs = end, vs_name
+
+    for ip, vrfs in ip_vrfs.items():
+        if len(vrfs) > 1:
+            vs_names = sorted({r[2] for vrf in vrfs
+                               for r in vip_index[(vrf, ip)]})
+            conflicts.append(['VIP in multiple VRFs',
+                              ','.join(sorted(vrf_names[v] for v in vrfs)),
+                              ip, '', ','.join(vs_names)])
+
+    server_index = defaultdict(list)
+    for p in pool_objects:
+        vrf = p.get('vrf_ref', '')
+        vrf_names.setdefault(vrf, ref_name(vrf) if '#' in vrf else vrf)
+        for server in p.get('servers', []):
+            port = server.get('port', p.get('default_server_port'))
+            server_index[(vrf, server['ip']['addr'], port)].append(p['name'])
+
+    for (vrf, ip, port), pool_names in server_index.items():
+        if len(pool_names) > 1:
+            conflicts.append(['Shared pool server', vrf_names[vrf], ip,
+                              port, ','.join(sorted(set(pool_names)))])
+
+        ranges = vip_index.get((vrf, ip))
+        if ranges and port is not None:
+            candidates = ranges[:bisect_right(ranges, (port, float('inf')))]
+            vs_names = sorted({vs_name for start, end, vs_name in candidates
+                               if end >= port})
+            if vs_names:
+                conflicts.append(['Pool server is a VIP', vrf_names[vrf], ip,
+                                  port, ','.join(vs_names + pool_names)])
+
+    return sorted(conflicts, key=lambda c: (c[0], c[1], c[2], str(c[3])))
+
+
+def find_capacity(vs_objects, se_objects, se_resources, hotspot_factor):
+    # Builds SE -> placed VSs and SEG -> SEs indexes, then flags SEs whose
+    # VS density (VSs per vCPU) is more than hotspot_factor times the
+    # average for their SE Group
+
+    se_vs = defaultdict(set)
+    for vs in vs_objects:
+        for v in vs.get('runtime', {}).get('vip_summary', []):
+            for se in v.get('service_engine', []):
+                se_uuid = se['url'].split('/api/serviceengine/')[1].split(
+                    '#')[0]
+                se_vs[se_uuid].add(vs['config']['name'])
+
+    seg_ses = defaultdict(list)
+    for s in se_objects:
+        seg_ses[ref_name(s['config']['se_group_ref'])].append(s)
+
+    capacity = []
+    for seg_name, ses in seg_ses.items():
+        densities = {}
+        for s in ses:
+            s_uuid = s['config']['uuid']
+            vcpus = se_resources.get(s_uuid, {}).get('num_vcpus')
+            densities[s_uuid] = (len(se_vs[s_uuid]) / vcpus if vcpus
+                                 else None)
+        known = [d for d in densities.values() if d is not None]
+        seg_average = sum(known) / len(known) if known else None
+
+        for s in ses:
+            s_uuid = s['config']['uuid']
+            resources = se_resources.get(s_uuid, {})
+            density = densities[s_uuid]
+            hotspot = (density is not None and seg_average
+                       and density > hotspot_factor * seg_average)
+            capacity.append([s['config']['name'], seg_name, oper_state(s),
+                             resources.get('num_vcpus', '-'),
+                             resources.get('memory', '-'),
+                             len(se_vs[s_uuid]),
+                             '-' if density is None else round(density, 2),
+                             '-' if seg_average is None
+                             else round(seg_average, 2),
+                             'Yes' if hotspot else ''])
+
+    return sorted(capacity, key=lambda c: (c[1], -c[5], c[0]))
+
+
+def build_rows(objects, column_defs, columns, contexts=None):
+    # Only the functions for the selected columns are ever called
+
+    column_funcs = [column_defs[c][2] for c in columns]
+    if contexts is None:
+        return [[func(obj, {}) for func in column_funcs] for obj in objects]
+    return [[func(obj, ctx) for func in column_funcs]
+            for obj, ctx in zip(objects, contexts)]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -32,10 +734,43 @@ if __name__ == '__main__':
     parser.add_argument('-x', '--apiversion', help='Avi API version')
     parser.add_argument('-i', '--inventorytype',
                         help='Inventory type (vs, pool, pooldetail, '
-                             'se, sedetail)',
-                        choices=['vs', 'pool', 'pooldetail', 'se', 'sedetail'],
+                             'se, sedetail), a comma-separated list of '
+                             'types or "all" (vs, pooldetail and sedetail)',
                         default='vs')
-    parser.add_argument('-f', '--file', help='Output to named CSV file ')
+    parser.add_argument('-f', '--file', help='Output to named CSV file. If '
+                             'multiple inventory types are requested, the '
+                             'type is appended to the filename.')
+    parser.add_argument('-w', '--workers',
+                        help='Number of concurrent API requests',
+                        type=int, default=8)
+    parser.add_argument('-s', '--serial',
+                        help='Retrieve inventory pages one at a time (for '
+                             'comparison with the concurrent engine)',
+                        action='store_true')
+    parser.add_argument('-a', '--analysis',
+                        help='Run an analysis across the inventory instead '
+                             'of outputting inventory data: "conflicts" '
+                             'reports duplicate VIPs, shared pool servers '
+                             'and pool servers that are VIPs; "capacity" '
+                             'reports VS placement density per SE',
+                        choices=['conflicts', 'capacity'])
+    parser.add_argument('-hf', '--hotspotfactor',
+                        help='Flag SEs whose VSs per vCPU exceeds the SE '
+                             'Group average by this factor (capacity '
+                             'analysis)',
+                        type=float, default=1.5)
+    parser.add_argument('-co', '--columns',
+                        help='Comma-separated list of columns to output. '
+                             'Only the data needed for these columns is '
+                             'requested from the Controller.')
+    parser.add_argument('-d', '--delta',
+                        help='Snapshot file for delta inventory (vs, pool or '
+                             'se only). Only objects modified since the '
+                             'snapshot are retrieved in full, and the '
+                             'snapshot is then updated.')
+    parser.add_argument('-cf', '--changesfile',
+                        help='Output the list of changed objects in delta '
+                             'mode to named CSV file')
 
     args = parser.parse_args()
 
@@ -49,8 +784,38 @@ if __name__ == '__main__':
         password = args.password
         tenant = args.tenant
         api_version = args.apiversion
-        inventory_type = args.inventorytype
+        inventory_types = (['vs', 'pooldetail', 'sedetail']
+                           if args.inventorytype == 'all' else
+                           list(dict.fromkeys(
+                               args.inventorytype.lower().split(','))))
+        inventory_type = inventory_types[0]
         csv_filename = args.file
+        workers = args.workers
+        serial = args.serial
+        delta_filename = args.delta
+        changes_filename = args.changesfile
+        analysis = args.analysis
+
+        unknown_types = [t for t in inventory_types
+                         if t not in INVENTORY_TYPES]
+        if unknown_types:
+            print(f'Unknown inventory type {",".join(unknown_types)}')
+            exit()
+
+        if len(inventory_types) > 1 and (delta_filename or args.columns):
+            print('Delta inventory and column selection are only supported '
+                  'for a single inventory type')
+            exit()
+
+        if delta_filename and inventory_type not in DELTA_TYPES:
+            print(f'Delta inventory is not supported for {inventory_type}')
+            exit()
+
+        try:
+            columns = parse_columns(inventory_type, args.columns)
+        except ValueError as ex:
+            print(ex)
+            exit()
 
         while not controller:
             controller = input('Controller:')
@@ -67,194 +832,100 @@ if __name__ == '__main__':
             print(f'Discovered Controller version {api_version}.')
         api = ApiSession.get_session(controller, user, password,
                                      api_version=api_version)
-        output_table = []
-        headers = []
-
-        if inventory_type == 'vs':
-            vs_inventory = api.get_objects_iter('virtualservice-inventory',
-                                                params={'include_name': True},
-                                                tenant=tenant)
-            for vs in vs_inventory:
-                vs_config = vs['config']
-                vs_runtime = vs['runtime']
-                vs_name = vs_config['name']
-                vs_uuid = vs_config['uuid']
-                vs_type = vs_config['type'].split('VS_TYPE_')[1]
-                vs_seg = vs_config['se_group_ref'].split('#')[1]
-                vs_tenant = vs_config['tenant_ref'].split('#')[1]
-                vs_cloud = vs_config['cloud_ref'].split('#')[1]
-                vs_vrf = vs_config['vrf_context_ref'].split('#')[1]
-                vs_ports = [(s['port'], s['port_range_end'], s['enable_ssl'])
-                            for s in vs_config['services']]
-                vs_ports = ','.join([f'{a}' + ('' if a == b else f'-{b}') +
-                                     ('*' if c else '')
-                                     for (a, b, c) in vs_ports])
-                vs_waf = vs_config.get('waf_policy_ref', '#').split('#')[1]
-                vs_app_profile_type = vs.get('app_profile_type',
-                                             'APPLICATION_PROFILE_TYPE_UNKNOWN')
-                vs_app_type = vs_app_profile_type.split(
-                    'APPLICATION_PROFILE_TYPE_')[1]
-                all_ip_addresses = []
-                if vs_config['type'] == 'VS_TYPE_VH_CHILD':
-                    for v in vs.get('parent_vs_vip', []):
-                        all_ip_addresses.extend([v[ip_type]['addr']
-                                    for ip_type in ('ip_address', 'ip6_address')
-                                    if ip_type in v])
-                    vs_fqdns = ','.join(vs_config.get('vh_domain_name', []))
-                else:
-                    for v in vs_config.get('vip', []):
-                        all_ip_addresses.extend([v[ip_type]['addr']
-                                    for ip_type in ('ip_address', 'ip6_address')
-                                    if ip_type in v])
-                    vs_fqdns = ','.join([d['fqdn']
-                                        for d in vs_config.get('dns_info', [])])
-                vs_vips = ','.join(all_ip_addresses)
-                vs_selist = set()
-                if 'vip_summary' in vs_runtime:
-                    for v in vs_runtime['vip_summary']:
-                        if 'service_engine' in v:
-                            vs_selist.update(s['url'].split('#')[1]
-                                             for s in v['service_engine'])
-                vs_selist = ','.join(vs_selist)
-                vs_enabled = 'Enabled' if vs_config['enabled'] else 'Disabled'
-                vs_state = vs_runtime['oper_status']['state'].split('OPER_')[1]
-                vs_hs = vs['health_score']['health_score']
-                vs_pools = ','.join([p.split('#')[1] for p in vs['pools']])
-                vs_poolgroups = ','.join([pg.split('#')[1]
-                                         for pg in vs['poolgroups']])
-                output_table.append([vs_name, vs_uuid, vs_tenant, vs_cloud,
-                                     vs_vrf, vs_type, vs_seg, vs_vips, vs_fqdns,
-                                     vs_ports, vs_pools, vs_poolgroups,
-                                     vs_app_type, vs_waf, vs_enabled,
-                                     vs_state, vs_hs, vs_selist])
-            headers = ['Name', 'UUID', 'Tenant', 'Cloud', 'VRF', 'Type', 'SEG',
-                       'VIPs', 'FQDNs', 'Ports', 'Pools', 'Pool Groups',
-                       'App Type', 'WAF', 'State', 'Oper State', 'Health Score',
-                       'Service Engines']
-        elif inventory_type in ('pool', 'pooldetail'):
-            p_inventory = api.get_objects_iter('pool-inventory',
-                                               params={'include_name': True},
-                                               tenant=tenant)
-            for p in p_inventory:
-                p_config = p['config']
-                p_runtime = p['runtime']
-                p_name = p_config['name']
-                p_uuid = p_config['uuid']
-                p_tenant = p_config['tenant_ref'].split('#')[1]
-                p_cloud = p_config['cloud_ref'].split('#')[1]
-                p_vrf = p_config['vrf_ref'].split('#')[1]
-                p_port = p_config['default_server_port']
-                p_servers = p_config['num_servers']
-                p_state = p_runtime['oper_status']['state'].split('OPER_')[1]
-                p_hs = p['health_score']['health_score']
-                p_vs = ','.join([vs.split('#')[1]
-                                 for vs in p.get('virtualservices', [])])
-
-                output = [p_name, p_uuid, p_tenant, p_cloud, p_vrf, p_port,
-                          p_servers, p_state, p_hs, p_vs]
-
-                if inventory_type == 'pooldetail':
-                    ps_inventory = api.get_objects_iter(
-                        f'pool-inventory/{p_uuid}/server',
-                        params={'include_name': True},
-                        tenant=tenant)
-                    p_servers = [(ps['config']['ip']['addr'],
-                                  ps['config']['port'],
-                                  ps['runtime']['oper_status']['state'].split(
-                        'OPER_')[1],
-                        ps['health_score']['health_score'])
-                        for ps in ps_inventory]
-
-                    output.append(','.join([f'{a}' +
-                                            (f':{b}' if b != p_port else '') +
-                                            f' [{c},{d}]'
-                                            for (a, b, c, d) in p_servers]))
-
-                    vs_selist = set()
-                    for vs in p.get('virtualservices', []):
-                        vs_uuid = vs.split('/api/virtualservice/')[1]
-                        rsp = api.get(
-                            f'virtualservice-inventory/{vs_uuid}',
-                            params={'include_name': True},
-                            tenant=tenant)
-
-                        if rsp.status_code < 300:
-                            vs_runtime = rsp.json().get('runtime', {})
-                        else:
-                            vs_runtime = {}
-
-                        if 'vip_summary' in vs_runtime:
-                            for v in vs_runtime['vip_summary']:
-                                if 'service_engine' in v:
-                                    vs_selist.update(s['url'].split('#')[1]
-                                                for s in v['service_engine'])
-                    output.append(','.join(vs_selist))
-
-                output_table.append(output)
-            headers = ['Name', 'UUID', 'Tenant', 'Cloud', 'VRF', 'Port',
-                       '#Servers', 'State', 'Health Score', 'Virtual Services']
-            if inventory_type == 'pooldetail':
-                headers.extend(['Servers', 'Service Engines'])
-        elif inventory_type in ('se', 'sedetail'):
-            if inventory_type == 'sedetail':
-                s_objects = api.get_objects_iter('serviceengine',
-                                    params={'include_name': True,
-                                    'fields': 'resources'},
-                                    tenant=tenant)
-                s_details = {s['uuid']: s['resources'] for s in s_objects}
-
-            s_inventory = api.get_objects_iter('serviceengine-inventory',
-                                               params={'include_name': True},
-                                               tenant=tenant)
-
-            for s in s_inventory:
-                s_config = s['config']
-                s_runtime = s['runtime']
-                s_name = s_config['name']
-                s_uuid = s_config['uuid']
-                s_tenant = s_config['tenant_ref'].split('#')[1]
-                s_cloud = s_config['cloud_ref'].split('#')[1]
-                s_seg = s_config['se_group_ref'].split('#')[1]
-                s_enabled = s_config['enable_state'].split('SE_STATE_')[1]
-                s_state = s_runtime['oper_status']['state'].split('OPER_')[1]
-                s_connected = ('Connected' if s_runtime['se_connected']
-                               else 'Not connected')
-                s_version = s_runtime['version']
-                s_online = s_runtime['online_since']
-                s_hs = s['health_score']['health_score']
-                s_vs = ','.join([v.split('#')[1]
-                                 for v in s_config['virtualservice_refs']])
-
-                output = [s_name, s_uuid, s_tenant, s_cloud, s_seg, s_enabled,
-                          s_state, s_connected, s_version, s_online, s_hs,
-                          s_vs]
-
-                if inventory_type == 'sedetail':
-                    s_detail = s_details.get(s_uuid, {})
-                    s_vcpu = s_detail.get('num_vcpus', '-')
-                    s_memory = s_detail.get('memory', '-')
-                    s_disk = s_detail.get('disk', '-')
-                    s_qat = s_detail.get('qat_mode', 'QAT_N/A').split('QAT_')[1]
-                    output.extend([s_vcpu, s_memory, s_disk, s_qat])
-
-                output_table.append(output)
-
-            headers = ['Name', 'UUID', 'Tenant', 'Cloud', 'SEG', 'State',
-                       'Oper State', 'Connectivity', 'Version', 'Online Since',
-                       'Health Score', 'Virtual Services']
-
-            if inventory_type == 'sedetail':
-                headers.extend(['vCPUs', 'Memory (MB)', 'Disk (GB)',
-                                'QAT Mode'])
-        if csv_filename:
-            print(f'Outputting data to {csv_filename}')
-            with open(csv_filename, 'w',
-                      newline='', encoding='UTF-8') as csv_file:
-                csv_writer = csv.writer(csv_file, dialect='excel')
-                csv_writer.writerow(headers)
-                csv_writer.writerows(output_table)
+
+        # Count every API response from here on so the cost of the report
+        # can be shown at the end
+
+        api_calls = count()
+
+        def count_call(rsp, *hook_args, **hook_kwargs):
+            # Response hooks must return None or the response is replaced
+            next(api_calls)
+
+        api.hooks['response'].append(count_call)
+
+        collector = InventoryCollector(api, tenant, workers=workers,
+                                       serial=serial)
+        start_time = time.perf_counter()
+
+        changes = None
+
+        if delta_filename:
+            try:
+                with open(delta_filename, 'r',
+                          encoding='UTF-8') as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+            except FileNotFoundError:
+                print(f'No snapshot found in {delta_filename} - '
+                      f'retrieving full inventory')
+                snapshot = {}
+
+            if snapshot and (snapshot.get('inventory_type') != inventory_type
+                             or snapshot.get('tenant') != tenant
+                             or snapshot.get('columns') != columns):
+                print(f'Snapshot in {delta_filename} is for a different '
+                      f'inventory type, tenant or columns - retrieving full '
+                      f'inventory')
+                snapshot = {}
+
+            headers, output_table, changes, snapshot = (
+                collector.delta_inventory(inventory_type, snapshot, columns))
+
+            with open(delta_filename, 'w',
+                      encoding='UTF-8') as snapshot_file:
+                json.dump(snapshot, snapshot_file)
+
+            results = {inventory_type: (headers, output_table)}
+        elif analysis == 'conflicts':
+            results = {analysis: collector.conflict_analysis()}
+        elif analysis == 'capacity':
+            results = {analysis: collector.capacity_analysis(
+                args.hotspotfactor)}
         else:
-            print(tabulate(output_table, headers=headers, tablefmt='outline'))
+            results = collector.collect(inventory_types,
+                                        {inventory_type: columns})
+
+        collector.close()
+        elapsed = time.perf_counter() - start_time
+
+        for inventory_type, (headers, output_table) in results.items():
+            if csv_filename:
+                if len(results) > 1:
+                    base, ext = os.path.splitext(csv_filename)
+                    type_filename = f'{base}_{inventory_type}{ext}'
+                else:
+                    type_filename = csv_filename
+                print(f'Outputting data to {type_filename}')
+                with open(type_filename, 'w',
+                          newline='', encoding='UTF-8') as csv_file:
+                    csv_writer = csv.writer(csv_file, dialect='excel')
+                    csv_writer.writerow(headers)
+                    csv_writer.writerows(output_table)
+            else:
+                if len(results) > 1:
+                    print(f'{inventory_type} inventory:')
+                print(tabulate(output_table, headers=headers,
+                               tablefmt='outline'))
+
+        if changes is not None:
+            change_headers = ['Change', 'Name', 'UUID']
+            if changes_filename:
+                print(f'Outputting {len(changes)} changes to '
+                      f'{changes_filename}')
+                with open(changes_filename, 'w',
+                          newline='', encoding='UTF-8') as csv_file:
+                    csv_writer = csv.writer(csv_file, dialect='excel')
+                    csv_writer.writerow(change_headers)
+                    csv_writer.writerows(changes)
+            elif changes:
+                print(tabulate(changes, headers=change_headers,
+                               tablefmt='outline'))
+            else:
+                print('No changes since the previous snapshot.')
+
+        num_rows = sum(len(rows) for _, rows in results.values())
+        print(f'Collected {num_rows} rows in {elapsed:.2f}s '
+              f'using {next(api_calls)} API calls.')
 
     else:
         parser.print_help()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+"""Script to show which objects depend on a given object (e.g. before
+changing a shared profile, certificate or health monitor) or which objects
+a given object depends on, transitively. An index of all object references
+is cached on disk and only refreshed for object types that have changed."""
+
+import argparse
+import getpass
+import json
+import re
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import urllib3
+from avi.sdk.avi_api import ApiSession, APIError, ObjectNotFound
+from tabulate import tabulate
+
+OBJECT_TYPES = {'actiongroupconfig', 'alertconfig', 'alertemailconfig',
+                'alertscriptconfig', 'alertsyslogconfig', 'analyticsprofile',
+                'applicationpersistenceprofile', 'applicationprofile',
+                'authmappingprofile', 'authprofile', 'autoscalelaunchconfig',
+                'availabilityzone', 'backupconfiguration',
+                'botconfigconsolidator', 'botdetectionpolicy',
+                'botipreputationtypemapping', 'botmapping',
+                'certificatemanagementprofile', 'cloud', 'cloudconnectoruser',
+                'controllerproperties', 'csrfpolicy', 'customipamdnsprofile',
+                'dnspolicy', 'errorpagebody', 'errorpageprofile', 'geodb',
+                'gslbgeodbprofile', 'gslbservice',
+                'hardwaresecuritymodulegroup', 'healthmonitor',
+                'httppolicyset', 'icapprofile', 'ipaddrgroup',
+                'ipamdnsproviderprofile', 'ipreputationdb', 'jwtserverprofile',
+                'l4policyset', 'labelgroup', 'natpolicy', 'network',
+                'networkprofile', 'networksecuritypolicy', 'networkservice',
+                'pingaccessagent', 'pkiprofile', 'pool', 'poolgroup',
+                'poolgroupdeploymentpolicy', 'prioritylabels',
+                'protocolparser', 'role', 'scheduler', 'securitypolicy',
+                'serverautoscalepolicy', 'serviceengine',
+                'serviceenginegroup', 'snmptrapprofile',
+                'sslkeyandcertificate', 'sslprofile', 'ssopolicy',
+                'stringgroup', 'systemconfiguration', 'tenant',
+                'trafficcloneprofile', 'user', 'useraccountprofile',
+                'vcenterserver', 'virtualservice', 'vrfcontext',
+                'vsdatascriptset', 'vsvip', 'wafcrs', 'wafpolicy',
+                'wafpolicypsmgroup', 'wafprofile', 'webhook'}
+
+REF_PATTERN = re.compile(r'/api/[a-z0-9]+/([a-z0-9]+-[0-9a-f-]+)')
+
+CACHE_VERSION = 1
+
+# Disable certificate warnings
+
+if hasattr(requests.packages.urllib3, 'disable_warnings'):
+    requests.packages.urllib3.disable_warnings()
+
+if hasattr(urllib3, 'disable_warnings'):
+    urllib3.disable_warnings()
+
+
+def find_refs(value, refs):
+    # Collects the UUIDs of every object reference found anywhere within
+    # an object
+
+    if isinstance(value, dict):
+        for v in value.values():
+            find_refs(v, refs)
+    elif isinstance(value, list):
+        for v in value:
+            find_refs(v, refs)
+    elif isinstance(value, str) and '/api/' in value:
+        refs.update(REF_PATTERN.findall(value))
+
+
+def type_stamp(api, object_type):
+    # A cheap fingerprint of the current state of an object type: the
+    # object count and the most recent modification time. Any creation,
+    # modification or deletion changes one or the other.
+
+    try:
+        rsp = api.get(object_type, tenant='*',
+                      params={'fields': '_last_modified',
+                              'sort': '-_last_modified', 'page_size': 1})
+    except (APIError, ObjectNotFound):
+        return None
+    if rsp.status_code >= 300:
+        return None
+    rsp_data = rsp.json()
+    results = rsp_data.get('results', [])
+    return [rsp_data.get('count', 0),
+            results[0].get('_last_modified') if results else None]
+
+
+def fetch_type_index(api, object_type):
+    # Returns {uuid: [name, tenant, refs]} for every object of the type
+    # across all tenants, and whether the whole type was fetched
+
+    objects = {}
+    try:
+        for obj in api.get_objects_iter(object_type, tenant='*',
+                                        params={'include_name': True}):
+            refs = set()
+            find_refs(obj, refs)
+            refs.discard(obj['uuid'])
+            tenant_ref = obj.get('tenant_ref', '')
+            objects[obj['uuid']] = [obj.get('name', obj['uuid']),
+                                    tenant_ref.split('#')[1]
+                                    if '#' in tenant_ref else '',
+                                    sorted(refs)]
+    except (APIError, ObjectNotFound):
+        # Usually the object type is not supported by this Controller
+        # version, but the fetch may also have failed part way through
+
+        return objects, False
+    return objects, True
+
+
+def load_cache(cache_file, controller):
+    try:
+        with open(cache_file, encoding='UTF-8') as f:
+            cache = json.load(f)
+    except (OSError, json.decoder.JSONDecodeError):
+        return {}
+    if (cache.get('version') != CACHE_VERSION
+            or cache.get('controller') != controller):
+        return {}
+    return cache.get('types', {})
+
+
+def refresh_index(api, cached_types, workers=8, rebuild=False):
+    # Fetches the stamp of every object type concurrently and re-fetches
+    # only the types whose stamp differs from the cached one (or all types
+    # if rebuilding). A type that could not be fetched completely is
+    # marked as incomplete so that it is fetched again next time.
+    # Returns the updated per-type index and the list of types that were
+    # re-fetched.
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        object_types = sorted(OBJECT_TYPES)
+        stamps = dict(zip(object_types,
+                          executor.map(lambda object_type:
+                                       type_stamp(api, object_type),
+                                       object_types)))
+        stale = [object_type for object_type in object_types
+                 if rebuild or object_type not in cached_types
+                 or not cached_types[object_type].get('complete', True)
+                 or cached_types[object_type]['stamp']
+                 != stamps[object_type]]
+        fetched = dict(zip(stale,
+                           executor.map(lambda object_type:
+                                        fetch_type_index(api, object_type),
+                                        stale)))
+
+    types = {object_type: cached_types[object_type]
+             for object_type in object_types
+             if object_type in cached_types and object_type not in fetched}
+    for object_type, (objects, complete) in fetched.items():
+        # A type with no stamp is not supported by the Controller, so
+        # there is nothing more to fetch
+
+        types[object_type] = {'stamp': stamps[object_type],
+                              'complete': (complete
+                                           or stamps[object_type] is None),
+                              'objects': objects}
+    return types, stale
+
+
+def build_index(types):
+    # Builds the forward (refers to) and reverse (referred by) indexes from
+    # the per-type index
+
+    objects = {}
+    refers_to = {}
+    referred_by = defaultdict(list)
+    for object_type, type_index in types.items():
+        for o_uuid, (name, tenant, refs) in type_index['objects'].items():
+            objects[o_uuid] = (object_type, name, tenant)
+            refers_to[o_uuid] = refs
+            for ref in refs:
+                referred_by[ref].append(o_uuid)
+    return objects, refers_to, referred_by
+
+
+def traverse(start_uuids, edges):
+    # Breadth-first traversal returning (uuid, depth, via uuid) for every
+    # object reachable from the start objects, nearest first
+
+    seen = set(start_uuids)
+    queue = deque((o_uuid, 0) for o_uuid in start_uuids)
+    found = []
+    while queue:
+        o_uuid, depth = queue.popleft()
+        for ref in edges.get(o_uuid, ()):
+            if ref not in seen:
+                seen.add(ref)
+                found.append((ref, depth + 1, o_uuid))
+                queue.append((ref, depth + 1))
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--controller',
+                        help='FQDN or IP address of Avi Controller')
+    parser.add_argument('-u', '--user', help='Avi API Username',
+                        default='admin')
+    parser.add_argument('-p', '--password', help='Avi API Password')
+    parser.add_argument('-t', '--tenant', help='Tenant of the object to '
+                                               'query (* for any tenant)',
+                        default='*')
+    parser.add_argument('-x', '--apiversion', help='Avi API version')
+    parser.add_argument('-d', '--dependencies',
+                        help='Show the objects the given object depends on '
+                             'rather than the objects that depend on it',
+                        action='store_true')
+    parser.add_argument('-m', '--maxdepth',
+                        help='Maximum depth of references to follow',
+                        type=int)
+    parser.add_argument('-cf', '--cachefile',
+                        help='Reference index cache file (default '
+                             '<controller>_references.json)')
+    parser.add_argument('-r', '--rebuild',
+                        help='Rebuild the reference index from scratch',
+                        action='store_true')
+    parser.add_argument('-w', '--workers',
+                        help='Number of object types to fetch concurrently',
+                        type=int, default=8)
+    parser.add_argument('objecttype', help='Type of object, e.g. '
+                                           'healthmonitor')
+    parser.add_argument('objectname', help='Name of object')
+
+    args = parser.parse_args()
+
+    if args:
+        # If not specified on the command-line, prompt the user for the
+        # controller IP address and/or password
+
+        controller = args.controller
+        user = args.user
+        password = args.password
+        tenant = args.tenant
+        api_version = args.apiversion
+        object_type = args.objecttype.lower()
+        object_name = args.objectname
+        show_dependencies = args.dependencies
+        max_depth = args.maxdepth
+        rebuild = args.rebuild
+        workers = args.workers
+
+        while not controller:
+            controller = input('Controller:')
+
+        cache_file = args.cachefile or f'{controller}_references.json'
+
+        while not password:
+            password = getpass.getpass(f'Password for {user}@{controller}:')
+
+        if not api_version:
+            # Discover Controller's version if no API version specified
+
+            api = ApiSession.get_session(controller, user, password)
+            api_version = api.remote_api_version['Version']
+            api.delete_session()
+            print(f'Discovered Controller version {api_version}.')
+        api = ApiSession.get_session(controller, user, password,
+                                     api_version=api_version)
+
+        start_time = time.perf_counter()
+        cached_types = {} if rebuild else load_cache(cache_file, controller)
+        types, stale = refresh_index(api, cached_types, workers, rebuild)
+        if stale:
+            with open(cache_file, 'w', encoding='UTF-8') as f:
+                json.dump({'version': CACHE_VERSION,
+                           'controller': controller,
+                           'types': types}, f)
+        print(f'Reference index ready in '
+              f'{time.perf_counter() - start_time:.2f}s '
+              f'({len(stale)} of {len(types)} object types refreshed).')
+        for i_type, type_index in sorted(types.items()):
+            if not type_index.get('complete', True):
+                print(f'Unable to fetch all {i_type} objects, so '
+                      f'references may be missing.')
+
+        objects, refers_to, referred_by = build_index(types)
+        start_uuids = [o_uuid for o_uuid, (o_type, o_name, o_tenant)
+                       in objects.items()
+                       if o_type == object_type and o_name == object_name
+                       and tenant in ('*', o_tenant)]
+        if not start_uuids:
+            print(f'Unable to find {object_type} {object_name}.')
+            exit()
+
+        found = traverse(start_uuids,
+                         refers_to if show_dependencies else referred_by)
+        if max_depth is not None:
+            found = [f_obj for f_obj in found if f_obj[1] <= max_depth]
+
+        if found:
+            print(tabulate([[depth, *objects.get(o_uuid, ('?', o_uuid, '')),
+                             objects.get(via, ('', via))[1]]
+                            for o_uuid, depth, via in found],
+                           headers=['Depth', 'Type', 'Name', 'Tenant',
+                                    'Via'],
+                           tablefmt='outline'))
+        else:
+            relation = ('are referenced by' if show_dependencies
+                        else 'refer to')
+            print(f'No objects {relation} {object_type} {object_name}.')
+    else:
+        parser.print_help()
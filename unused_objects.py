@@ -5,6 +5,10 @@ are no longer referenced."""
 
 import argparse
 import getpass
+import re
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import requests
 import urllib3
@@ -38,6 +42,33 @@ OBJECT_TYPES = {'actiongroupconfig', 'alertconfig', 'alertemailconfig',
 
 EXCLUDE_OBJECT_TYPES = {'virtualservice', 'gslbservice', 'network', 'wafcrs'}
 
+# Objects of these types are always considered to be in use when building
+# the reference graph. Any object reachable from them is also in use. As
+# well as the excluded types, this includes standalone configuration that
+# takes effect without being referenced by anything.
+
+ROOT_OBJECT_TYPES = EXCLUDE_OBJECT_TYPES | {'serviceengine',
+                                            'systemconfiguration',
+                                            'controllerproperties', 'user',
+                                            'backupconfiguration',
+                                            'alertconfig', 'networkservice',
+                                            'availabilityzone',
+                                            'vcenterserver'}
+
+REF_PATTERN = re.compile(r'/api/[a-z0-9]+/([a-z0-9]+-[0-9a-f-]+)')
+
+# References in a configuration export are by name rather than UUID, e.g.
+# /api/pool/?tenant=admin&name=example-pool. Names may contain spaces, so
+# the query runs to the closing quote of the JSON string.
+
+EXPORT_REF_PATTERN = re.compile(r'/api/([a-z0-9]+)/?\?((?:[^"\\]|\\.)*)')
+
+EXPORT_CHUNK_SIZE = 1 << 20
+
+# Maximum seconds to wait before retrying failed deletions
+
+RETRY_BACKOFF_LIMIT = 8
+
 SPECIAL_OBJECT_NAMES = {'vrfcontext': ['management'],
                         'certificatemanagementprofile':
                             ['LetsEncryptCertificateManagementProfile'],
@@ -73,6 +104,463 @@ if hasattr(requests.packages.urllib3, 'disable_warnings'):
 if hasattr(urllib3, 'disable_warnings'):
     urllib3.disable_warnings()
 
+
+def scan_error_message(object_type, ex):
+    if isinstance(ex, ObjectNotFound):
+        # ObjectNotFound means the object type isn't even understood
+        # by the API server, which indicates the object type is
+        # not supported by the Controller version. We can silently
+        # ignore this error and continue.
+
+        return (f'Unable to check for unused {object_type}: '
+                'Object type was not found.')
+
+    # APIError here will usually be due to the object type being
+    # deprecated. We can silently ignore this error and continue.
+
+    try:
+        api_err = json.loads(ex.rsp.text)
+    except json.decoder.JSONDecodeError:
+        api_err = {'message': 'Unknown error.'}
+    return (f'Unable to check for unused {object_type} '
+            f'objects: {api_err["message"]}')
+
+
+def is_system_object(object_type, name):
+    return (name.startswith('System-')
+            or name in SPECIAL_OBJECT_NAMES.get(object_type, []))
+
+
+def scan_object_type(api, tenant, object_type, include_system):
+    # Returns the unused objects of the given type as (name, tenant, uuid,
+    # url) tuples, along with any error message and the time taken
+
+    start_time = time.perf_counter()
+    err_msg = None
+
+    unused_objects = api.get_objects_iter(object_type, tenant=tenant,
+                                          params={
+                                              'referred_by': 'any:none',
+                                              'fields': 'tenant_ref',
+                                              'include_name': True})
+    try:
+        filtered_unused = [(u_obj['name'],
+                            u_obj.get('tenant_ref', '').split('#')[1],
+                            u_obj['uuid'],
+                            u_obj['url'])
+                        for u_obj in unused_objects
+                        if (include_system or not
+                            is_system_object(object_type, u_obj['name']))]
+    except (APIError, ObjectNotFound) as ex:
+        filtered_unused = []
+        err_msg = scan_error_message(object_type, ex)
+
+    return filtered_unused, err_msg, time.perf_counter() - start_time
+
+
+def find_refs(value, refs, pattern=REF_PATTERN):
+    # Collects every object reference found anywhere within an object. For
+    # live objects these are UUIDs, for exported objects (type, query)
+    # tuples.
+
+    if isinstance(value, dict):
+        for v in value.values():
+            find_refs(v, refs, pattern)
+    elif isinstance(value, list):
+        for v in value:
+            find_refs(v, refs, pattern)
+    elif isinstance(value, str) and '/api/' in value:
+        refs.update(pattern.findall(value))
+
+
+class ReferenceGraph:
+    def __init__(self):
+        self.objects = {}
+        self.refers_to = defaultdict(set)
+        self.referred_by = defaultdict(set)
+
+        # The UUIDs the Controller reports as not referenced by anything,
+        # for each object type checked
+
+        self.unreferenced = {}
+
+    def add_object(self, object_type, obj):
+        tenant_ref = obj.get('tenant_ref', '')
+        refs = set()
+        find_refs(obj, refs)
+        self.add_node(obj['uuid'], object_type, obj.get('name', obj['uuid']),
+                      tenant_ref.split('#')[1] if '#' in tenant_ref else '',
+                      obj.get('url', '').split('#')[0], refs)
+
+    def add_node(self, o_uuid, object_type, name, tenant, url, refs):
+        self.objects[o_uuid] = (object_type, name, tenant, url)
+        refs.discard(o_uuid)
+        self.refers_to[o_uuid] = refs
+        for ref in refs:
+            self.referred_by[ref].add(o_uuid)
+
+    def reachable(self, roots):
+        # Iterative depth-first traversal along references from the roots
+
+        seen = set(roots)
+        stack = list(roots)
+        while stack:
+            for ref in self.refers_to.get(stack.pop(), ()):
+                if ref not in seen:
+                    seen.add(ref)
+                    stack.append(ref)
+        return seen
+
+    def find_orphans(self, object_types, include_system, tenant='*'):
+        # Any object that cannot be reached by following references from a
+        # root object is an orphan, including objects whose only referrers
+        # are themselves orphans. Returns the orphans of each requested
+        # type in the same form as scan_object_type.
+        #
+        # Objects of types that are not analysed (e.g. from an export) are
+        # roots, as are objects with no referrers in the graph that the
+        # Controller reports as referenced: their referrers are of a type
+        # that was not fetched (or could not be).
+
+        roots = [o_uuid for o_uuid, (o_type, o_name, _, _)
+                 in self.objects.items()
+                 if o_type in ROOT_OBJECT_TYPES or o_type not in OBJECT_TYPES
+                 or (not include_system
+                     and is_system_object(o_type, o_name))
+                 or (o_type in self.unreferenced
+                     and not self.referred_by.get(o_uuid)
+                     and o_uuid not in self.unreferenced[o_type])]
+        reachable = self.reachable(roots)
+
+        orphans = {object_type: [] for object_type in object_types}
+        for o_uuid, (o_type, o_name, o_tenant, o_url) in self.objects.items():
+            if (o_uuid not in reachable and o_type in orphans
+                    and tenant in ('*', o_tenant)):
+                orphans[o_type].append((o_name, o_tenant, o_uuid, o_url))
+        for orphan_list in orphans.values():
+            orphan_list.sort()
+        return orphans
+
+    def is_cascading(self, o_uuid):
+        return bool(self.referred_by.get(o_uuid))
+
+
+def fetch_object_type(api, object_type):
+    start_time = time.perf_counter()
+    try:
+        objects = list(api.get_objects_iter(object_type, tenant='*',
+                                            params={'include_name': True}))
+        err_msg = None
+    except (APIError, ObjectNotFound) as ex:
+        objects = []
+        err_msg = scan_error_message(object_type, ex)
+    return objects, err_msg, time.perf_counter() - start_time
+
+
+def build_reference_graph(api, object_types, check_types=(), workers=8):
+    # Fetches every object of every type (across all tenants, as objects
+    # may be referenced from other tenants) concurrently and builds the
+    # reference graph. For each of check_types, the objects the Controller
+    # reports as unreferenced are also fetched, so that references from
+    # types not in the graph are not mistaken for absent ones. Returns the
+    # graph, any errors and fetch times.
+
+    graph = ReferenceGraph()
+    errors = {}
+    fetch_times = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        fetches = {object_type: executor.submit(fetch_object_type, api,
+                                                object_type)
+                   for object_type in sorted(object_types)}
+        checks = {object_type: executor.submit(scan_object_type, api, '*',
+                                               object_type, True)
+                  for object_type in sorted(check_types)}
+        for object_type, fetch in fetches.items():
+            objects, errors[object_type], fetch_times[object_type] = (
+                fetch.result())
+            for obj in objects:
+                graph.add_object(object_type, obj)
+        for object_type, check in checks.items():
+            unused, err_msg, _ = check.result()
+            if not err_msg:
+                graph.unreferenced[object_type] = {u_obj[2]
+                                                   for u_obj in unused}
+
+    return graph, errors, fetch_times
+
+
+def iter_export_objects(filename):
+    # Stream-parses a configuration export, which is a JSON object mapping
+    # each object type to a list of objects, yielding one (object type,
+    # object, raw JSON text) at a time so that the whole file is never held
+    # in memory.
+
+    decoder = json.JSONDecoder()
+    with open(filename, encoding='utf-8') as f:
+        buf = ''
+        pos = 0
+        eof = False
+
+        def next_char():
+            # Skips whitespace and returns the next significant character,
+            # reading further chunks from the file as required
+
+            nonlocal buf, pos, eof
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n':
+                    pos += 1
+                if pos < len(buf) or eof:
+                    return buf[pos] if pos < len(buf) else ''
+                buf = f.read(EXPORT_CHUNK_SIZE)
+                pos = 0
+                eof = not buf
+
+        def decode():
+            # Decodes the JSON value at the current position, reading
+            # further chunks until a complete value is available. Returns
+            # the value and its raw JSON text.
+
+            nonlocal buf, pos, eof
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    if end < len(buf) or eof:
+                        start, pos = pos, end
+                        return value, buf[start:end]
+                except json.decoder.JSONDecodeError:
+                    if eof:
+                        raise
+                chunk = f.read(EXPORT_CHUNK_SIZE)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+
+        if next_char() != '{':
+            raise ValueError(f'{filename} is not a configuration export')
+        pos += 1
+        while next_char() not in ('}', ''):
+            if buf[pos] == ',':
+                pos += 1
+                continue
+            type_key, _ = decode()
+            if next_char() != ':':
+                raise ValueError(f'Unexpected data in {filename}')
+            pos += 1
+            if next_char() != '[':
+                # Not a list of objects (e.g. the META section)
+
+                decode()
+                continue
+            pos += 1
+            while next_char() not in (']', ''):
+                if buf[pos] == ',':
+                    pos += 1
+                    continue
+                obj, raw = decode()
+                if isinstance(obj, dict):
+                    yield type_key, obj, raw
+            pos += 1
+
+
+def export_ref(ref_type, query):
+    # Returns the (type, tenant, name, cloud) identified by an export
+    # reference. Names in an export are not URL-encoded, so the query is
+    # split as-is (parse_qsl would turn a '+' in a name into a space).
+
+    params = dict(param.partition('=')[::2] for param in query.split('&'))
+    return (ref_type, params.get('tenant', 'admin'), params.get('name'),
+            params.get('cloud'))
+
+
+def load_export_graph(filename):
+    # Builds the reference graph from a configuration export. References
+    # are by name, so are resolved once every object has been indexed.
+    # Only names and references are kept rather than whole objects, and
+    # references are found by scanning the raw JSON text of each object
+    # rather than walking the decoded object.
+
+    graph = ReferenceGraph()
+    names = defaultdict(list)
+    nodes = []
+
+    # The same references recur across many objects, so each is parsed
+    # only once
+
+    ref_keys = {}
+
+    def ref_key(ref):
+        key = ref_keys.get(ref)
+        if key is None:
+            key = ref_keys[ref] = export_ref(*ref)
+        return key
+
+    def raw_ref_key(ref):
+        # References found in the raw JSON text may contain escapes
+
+        ref_type, query = ref
+        if '\\' in query:
+            query = json.loads(f'"{query}"')
+        return ref_key((ref_type, query))
+
+    for type_key, obj, raw in iter_export_objects(filename):
+        object_type = type_key.lower()
+        refs = tuple({raw_ref_key(ref)
+                      for ref in EXPORT_REF_PATTERN.findall(raw)})
+        o_tenant = ref_key(('tenant', obj.get('tenant_ref', '')
+                            .partition('?')[2]))[2] or 'admin'
+        o_cloud = ref_key(('cloud', obj.get('cloud_ref', '')
+                           .partition('?')[2]))[2]
+        o_name = obj.get('name', '')
+        o_uuid = obj.get('uuid') or f'{object_type}-{o_tenant}-{o_name}'
+        names[(object_type, o_tenant, o_name)].append((o_uuid, o_cloud))
+        nodes.append((o_uuid, object_type, o_name, o_tenant, refs))
+
+    for o_uuid, object_type, o_name, o_tenant, refs in nodes:
+        ref_uuids = set()
+        for ref_type, r_tenant, r_name, r_cloud in refs:
+            candidates = (names.get((ref_type, r_tenant, r_name))
+                          or names.get((ref_type, 'admin', r_name), []))
+            ref_uuids.update(c_uuid for c_uuid, c_cloud in candidates
+                             if not r_cloud or c_cloud in (r_cloud, None))
+        graph.add_node(o_uuid, object_type, o_name, o_tenant, '', ref_uuids)
+
+    return graph, len(nodes)
+
+
+def deletion_blockers(objects, referred_by):
+    # For each object to be deleted, the set of other objects being deleted
+    # that refer to it and so must be deleted first
+
+    return {o_uuid: referred_by.get(o_uuid, set()) & objects.keys()
+            for o_uuid in objects}
+
+
+def plan_deletion(objects, referred_by):
+    # Orders objects into waves such that each object is deleted only after
+    # every object being deleted that refers to it. Objects within a wave
+    # can be deleted concurrently. Objects that are part of a reference
+    # cycle cannot be ordered and are returned separately.
+
+    blockers = deletion_blockers(objects, referred_by)
+    waves = []
+    while blockers:
+        wave = [o_uuid for o_uuid, o_blockers in blockers.items()
+                if not o_blockers]
+        if not wave:
+            break
+        for o_uuid in wave:
+            del blockers[o_uuid]
+        for o_blockers in blockers.values():
+            o_blockers.difference_update(wave)
+        waves.append(sorted(wave, key=lambda o_uuid: objects[o_uuid]))
+    return waves, sorted(blockers, key=lambda o_uuid: objects[o_uuid])
+
+
+def delete_object(api, u_obj):
+    try:
+        return api.delete(u_obj[3].split('/api/')[1].split('#')[0],
+                          tenant=u_obj[1])
+    except requests.exceptions.RequestException as ex:
+        return ex
+
+
+def delete_objects(api, objects, referred_by, workers=8, retries=3):
+    # Deletes objects concurrently, starting the deletion of each object as
+    # soon as every object being deleted that refers to it has gone. Failed
+    # deletions are retried after further deletions have succeeded, as they
+    # may have been blocked by references not known in advance, or after a
+    # backoff if nothing else can be deleted. Returns
+    # the number of objects deleted, failed and skipped.
+
+    blockers = deletion_blockers(objects, referred_by)
+    dependents = defaultdict(set)
+    for o_uuid, o_blockers in blockers.items():
+        for blocker in o_blockers:
+            dependents[blocker].add(o_uuid)
+
+    ready = deque(sorted((o_uuid for o_uuid, o_blockers in blockers.items()
+                          if not o_blockers),
+                         key=lambda o_uuid: objects[o_uuid]))
+    retry = []
+    attempts = defaultdict(int)
+    running = {}
+    deleted = set()
+    failed = set()
+    skipped = set()
+    cycles_attempted = False
+
+    def describe(o_uuid):
+        object_type, u_obj = objects[o_uuid]
+        return f'{object_type} {" / ".join(u_obj[:3])}'
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while ready:
+                o_uuid = ready.popleft()
+                if (o_uuid in deleted or o_uuid in failed
+                        or o_uuid in running.values()):
+                    continue
+                running[executor.submit(delete_object, api,
+                                        objects[o_uuid][1])] = o_uuid
+
+            if not running:
+                if retry:
+                    # No deletion has succeeded since these failed (or they
+                    # would have been retried already), so back off before
+                    # retrying them
+
+                    time.sleep(min(2 ** (min(attempts[o_uuid]
+                                             for o_uuid in retry) - 1),
+                                   RETRY_BACKOFF_LIMIT))
+                    ready.extend(retry)
+                    retry = []
+                    continue
+
+                # Nothing is running or ready, so anything remaining is
+                # either blocked by an object that could not be deleted or
+                # is part of a reference cycle. The latter are attempted
+                # anyway in case the cycle is broken by the deletion.
+
+                remaining = (objects.keys() - deleted - failed - skipped)
+                if not remaining:
+                    break
+                for o_uuid in sorted(remaining,
+                                     key=lambda o_uuid: objects[o_uuid]):
+                    if cycles_attempted or blockers[o_uuid] & failed:
+                        skipped.add(o_uuid)
+                        print(f'Skipped {describe(o_uuid)}: still referenced '
+                              f'by objects that were not deleted')
+                    else:
+                        ready.append(o_uuid)
+                cycles_attempted = True
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                o_uuid = running.pop(future)
+                result = future.result()
+                status_code = getattr(result, 'status_code', None)
+                attempts[o_uuid] += 1
+                if status_code in (204, 404):
+                    deleted.add(o_uuid)
+                    print(f'Deleted {describe(o_uuid)}')
+                    for dependent in dependents[o_uuid]:
+                        blockers[dependent].discard(o_uuid)
+                        if not blockers[dependent]:
+                            ready.append(dependent)
+                    ready.extend(retry)
+                    retry = []
+                elif attempts[o_uuid] < retries:
+                    retry.append(o_uuid)
+                else:
+                    failed.add(o_uuid)
+                    print(f'Failed to delete {describe(o_uuid)}: '
+                          f'{result.text if status_code else result}')
+
+    return len(deleted), len(failed), len(skipped)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -93,6 +581,19 @@ if __name__ == '__main__':
     parser.add_argument('-v', '--verbose',
                         help='Include UUID in output',
                         action='store_true')
+    parser.add_argument('-w', '--workers',
+                        help='Number of object types to scan (and objects '
+                             'to delete) concurrently',
+                        type=int, default=8)
+    parser.add_argument('-g', '--graph',
+                        help='Build a reference graph of all objects to also '
+                             'find objects only referenced by other unused '
+                             'objects',
+                        action='store_true')
+    parser.add_argument('-e', '--export',
+                        help='Analyse a full configuration export file '
+                             'instead of querying the Controller (implies '
+                             '-g)')
     parser_d = parser.add_mutually_exclusive_group()
     parser_d.add_argument('-d', '--delete',
                           help='Allow deletion of unused objects '
@@ -101,6 +602,10 @@ if __name__ == '__main__':
     parser_d.add_argument('-f', '--force',
                           help='Delete unused objects without prompting',
                           action='store_true')
+    parser_d.add_argument('-n', '--plan',
+                          help='Show the order in which unused objects would '
+                               'be deleted without deleting them',
+                          action='store_true')
 
     args = parser.parse_args()
 
@@ -119,24 +624,34 @@ if __name__ == '__main__':
                         set(args.objecttypes.lower().split(',')) & OBJECT_TYPES)
         include_system = args.includesystem
         verbose = args.verbose
-        deletion = DELETE_ALL if args.force else (DELETE_PROMPT if args.delete
-                                                  else DELETE_NEVER)
+        workers = args.workers
+        export_file = args.export
+        use_graph = args.graph or bool(export_file)
+        plan_only = args.plan
+        deletion = (DELETE_ALL if args.force or plan_only
+                    else DELETE_PROMPT if args.delete else DELETE_NEVER)
 
-        while not controller:
-            controller = input('Controller:')
+        if export_file:
+            if deletion != DELETE_NEVER and not plan_only:
+                print('Objects cannot be deleted when analysing a '
+                      'configuration export.')
+                exit()
+        else:
+            while not controller:
+                controller = input('Controller:')
 
-        while not password:
-            password = getpass.getpass(f'Password for {user}@{controller}:')
+            while not password:
+                password = getpass.getpass(f'Password for {user}@{controller}:')
 
-        if not api_version:
-            # Discover Controller's version if no API version specified
+            if not api_version:
+                # Discover Controller's version if no API version specified
 
-            api = ApiSession.get_session(controller, user, password)
-            api_version = api.remote_api_version['Version']
-            api.delete_session()
-            print(f'Discovered Controller version {api_version}.')
-        api = ApiSession.get_session(controller, user, password,
-                                     api_version=api_version)
+                api = ApiSession.get_session(controller, user, password)
+                api_version = api.remote_api_version['Version']
+                api.delete_session()
+                print(f'Discovered Controller version {api_version}.')
+            api = ApiSession.get_session(controller, user, password,
+                                         api_version=api_version)
 
         if deletion == DELETE_PROMPT:
             print('Deletion action choices:')
@@ -147,45 +662,54 @@ if __name__ == '__main__':
             print('[A]ll = Delete all unused objects of all types')
             print()
 
-        for object_type in sorted(object_types):
-            unused_objects = api.get_objects_iter(object_type, tenant=tenant,
-                                                  params={
-                                                      'referred_by': 'any:none',
-                                                      'fields': 'tenant_ref',
-                                                      'include_name': True})
-            try:
-                filtered_unused = [(u_obj['name'],
-                                    u_obj.get('tenant_ref', '').split('#')[1],
-                                    u_obj['uuid'],
-                                    u_obj['url'])
-                                for u_obj in unused_objects
-                                if (include_system or not
-                                    (u_obj['name'].startswith('System-')
-                                        or u_obj['name'] in
-                                        SPECIAL_OBJECT_NAMES.get(object_type,
-                                                                 [])))]
-            except APIError as ex:
-                # APIError here will usually be due to the object type being
-                # deprecated. We can silently ignore this error and continue.
-
-                filtered_unused = []
-                try:
-                    err_msg = json.loads(ex.rsp.text)
-                except json.decoder.JSONDecodeError:
-                    err_msg = {'message': 'Unknown error.'}
-                print()
-                print(f'Unable to check for unused {object_type} '
-                      f'objects: {err_msg["message"]}')
-            except ObjectNotFound as ex:
-                # ObjectNotFound means the object type isn't even understood
-                # by the API server, which indicates the object type is
-                # not supported by the Controller version. We can silently
-                # ignore this error and continue.
-
-                filtered_unused = []
+        scan_start = time.perf_counter()
+        to_delete = {}
+
+        if use_graph:
+            # Fetch every object once and find orphans locally, including
+            # cascading orphans, rather than querying each type
+
+            if export_file:
+                print(f'Loading configuration export {export_file}...')
+                graph, object_count = load_export_graph(export_file)
+                errors = {}
+                scan_times = {}
+                print(f'Loaded {object_count} objects in '
+                      f'{time.perf_counter() - scan_start:.2f}s.')
+            else:
+                print('Building reference graph...')
+                graph, errors, scan_times = build_reference_graph(
+                    api, OBJECT_TYPES | ROOT_OBJECT_TYPES, object_types,
+                    workers)
+            orphans = graph.find_orphans(object_types, include_system,
+                                         tenant)
+            scan_results = ((object_type, (orphans[object_type],
+                                           errors.get(object_type)))
+                            for object_type in sorted(object_types))
+        else:
+            # Scan all object types concurrently. Results are buffered and
+            # processed in sorted order so that output and any deletion
+            # prompts remain serial and in the same order as before.
+
+            executor = ThreadPoolExecutor(max_workers=workers)
+            scans = {object_type: executor.submit(scan_object_type, api,
+                                                  tenant, object_type,
+                                                  include_system)
+                     for object_type in sorted(object_types)}
+            scan_times = {}
+
+            def scan_results_iter():
+                for object_type, scan in scans.items():
+                    unused, err_msg, scan_times[object_type] = scan.result()
+                    yield object_type, (unused, err_msg)
+                executor.shutdown()
+
+            scan_results = scan_results_iter()
+
+        for object_type, (filtered_unused, err_msg) in scan_results:
+            if err_msg:
                 print()
-                print(f'Unable to check for unused {object_type}: '
-                      'Object type was not found.')
+                print(err_msg)
 
             if filtered_unused or not all_objects:
                 print()
@@ -195,6 +719,8 @@ if __name__ == '__main__':
             for u_obj in filtered_unused:
                 u_obj_info = ' / '.join(u_obj[:(3 if verbose else 2
                                                 if tenant == '*' else 1)])
+                if use_graph and graph.is_cascading(u_obj[2]):
+                    u_obj_info += ' (only referenced by unused objects)'
                 print(u_obj_info)
                 delete_this = deletion in (DELETE_TYPE, DELETE_ALL)
                 if deletion == DELETE_PROMPT:
@@ -211,16 +737,50 @@ if __name__ == '__main__':
                     elif 'skip'.startswith(del_ch):
                         break
                 if delete_this:
-                    print(f'Deleting {" / ".join(u_obj[:3])}...', end='')
-                    result = api.delete(u_obj[3].split('/api/')[1],
-                                        tenant=u_obj[1])
-                    if result.status_code == 204:
-                        print('OK')
-                    else:
-                        print('Failed with {result.status_code}')
-                    print()
+                    to_delete[u_obj[2]] = (object_type, u_obj)
 
             if deletion == DELETE_TYPE:
                 deletion = DELETE_PROMPT
+
+        if scan_times:
+            print()
+            print(f'Scanned {len(scan_times)} object types in '
+                  f'{time.perf_counter() - scan_start:.2f}s:')
+            for object_type, scan_time in sorted(scan_times.items(),
+                                                 key=lambda t: -t[1]):
+                print(f'  {object_type}: {scan_time:.2f}s')
+
+        # Objects referenced by other objects being deleted can only be
+        # deleted after them. Without the reference graph, all unused
+        # objects are unreferenced and so can be deleted in any order.
+
+        referred_by = graph.referred_by if use_graph else {}
+
+        if plan_only and to_delete:
+            waves, cycles = plan_deletion(to_delete, referred_by)
+            print()
+            print('Deletion plan:')
+            for wave_num, wave in enumerate(waves, start=1):
+                print()
+                print(f'Wave {wave_num} ({len(wave)} objects):')
+                for o_uuid in wave:
+                    object_type, u_obj = to_delete[o_uuid]
+                    print(f'  {object_type}: {" / ".join(u_obj[:3])}')
+            if cycles:
+                print()
+                print(f'Reference cycles ({len(cycles)} objects):')
+                for o_uuid in cycles:
+                    object_type, u_obj = to_delete[o_uuid]
+                    print(f'  {object_type}: {" / ".join(u_obj[:3])}')
+        elif to_delete:
+            print()
+            print(f'Deleting {len(to_delete)} objects...')
+            delete_start = time.perf_counter()
+            deleted, failed, skipped = delete_objects(api, to_delete,
+                                                      referred_by, workers)
+            print()
+            print(f'Deleted {deleted} objects in '
+                  f'{time.perf_counter() - delete_start:.2f}s '
+                  f'({failed} failed, {skipped} skipped).')
     else:
         parser.print_help()